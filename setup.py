@@ -39,6 +39,8 @@ setup(name='markowik',
     install_requires=install_requires,
     entry_points={
         'console_scripts':
-            ['markowik=markowik.main:main']
+            ['markowik=markowik.main:main',
+             'markowik-bench=markowik.bench:main',
+             'markowik-compare=markowik.compare:main']
     }
 )
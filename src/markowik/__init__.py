@@ -3,10 +3,12 @@
 Detailed documentation can be found at http://pypi.python.org/pypi/markowik.
 
 """
-import re
+__version__ = "0.2"
 
-import markdown
+import re
 
-from markowik.main import convert, BadURL
+from markowik.main import convert, convertmany, validate, Converter
+from markowik.main import BadURL, UnknownTag
 
-__all__ = ["convert", "BadURL"]
+__all__ = ["convert", "convertmany", "validate", "Converter", "BadURL",
+           "UnknownTag"]
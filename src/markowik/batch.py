@@ -0,0 +1,327 @@
+"""
+Batch conversion of Markdown file trees.
+
+Modules needed only for actual conversions are imported lazily, i.e. checking
+for batch mode with `isbatch()` is cheap.
+
+"""
+import codecs
+import glob
+import hashlib
+import json
+import os
+import sys
+
+import markowik
+from markowik.errors import message
+from markowik.main import Converter, BadURL, UnknownTag
+from markowik.treecache import extensionnames
+from markowik.util import writefile
+
+# =============================================================================
+
+MDEXTS = ('.md', '.markdown', '.mdown', '.mkd')
+
+HTMLEXTS = ('.html', '.htm', '.xhtml') # when using the ``html`` frontend
+
+def isbatch(source):
+    """Check if `source` names a directory or a glob pattern."""
+
+    return os.path.isdir(source) or glob.has_magic(source)
+
+def basedir(source):
+    """Get the directory `source` file names are relative to."""
+
+    base = source
+    while glob.has_magic(base):
+        base = os.path.dirname(base)
+    return base
+
+def collect(source, exts=MDEXTS):
+    """
+    Collect Markdown files in a directory tree or matching a glob pattern.
+
+    Files in a directory tree are collected by their extensions `exts`.
+    Returns a list of input file names and corresponding file names relative
+    to `basedir(source)`.
+
+    """
+    if os.path.isdir(source):
+        fnames = []
+        for dirpath, _, files in os.walk(source):
+            fnames += [os.path.join(dirpath, x) for x in sorted(files)
+                       if os.path.splitext(x)[1].lower() in exts]
+    else:
+        fnames = sorted(x for x in glob.glob(source) if os.path.isfile(x))
+
+    base = basedir(source)
+    return [(x, os.path.relpath(x, base)) for x in fnames]
+
+def extensions(kwds):
+    """Get the extensions of files to convert with `Converter` options."""
+
+    return HTMLEXTS if kwds.get('frontend') == 'html' else MDEXTS
+
+def wikiname(outdir, relname):
+    """Get the wiki file name for a Markdown file name relative to `outdir`."""
+
+    return os.path.join(outdir, "%s.wiki" % os.path.splitext(relname)[0])
+
+# =============================================================================
+# workers
+# =============================================================================
+
+_converter = None # per worker process
+_diagnose = False # whether to get diagnostics of conversions
+
+def _initworker(kwds, diagnose=False):
+
+    global _converter, _diagnose
+    _converter = Converter(**kwds)
+    _diagnose = diagnose
+
+def _convertfile(job):
+    """
+    Convert one file (`job` is an input and output file name pair).
+
+    Returns the input file name, an error message (`None` on success), and
+    the conversion's diagnostics (see `Converter.diagnostics()`, only if
+    requested when initializing the worker).
+
+    """
+    infile, outfile = job
+    encoding = _converter.mdx.encoding
+    try:
+        with codecs.open(infile, 'r', encoding) as fp:
+            md = fp.read()
+        pieces = _converter.iterconvert(md)
+        outdir = os.path.dirname(outfile)
+        if outdir and not os.path.isdir(outdir):
+            try:
+                os.makedirs(outdir)
+            except OSError: # created concurrently by another worker
+                if not os.path.isdir(outdir):
+                    raise
+        writefile(outfile, pieces, encoding)
+    except (BadURL, UnknownTag, IOError, OSError, UnicodeError) as e:
+        return infile, message(e), []
+    return infile, None, _converter.diagnostics() if _diagnose else []
+
+def _validatefile(infile):
+    """
+    Validate one file.
+
+    Returns the input file name, the problems found (see
+    `Converter.validate()`), and an error message (`None` if the file could
+    be validated).
+
+    """
+    try:
+        with codecs.open(infile, 'r', _converter.mdx.encoding) as fp:
+            md = fp.read()
+        return infile, _converter.validate(md), None
+    except (IOError, UnicodeError) as e:
+        return infile, [], message(e)
+
+# =============================================================================
+
+def _run(todo, jobs, kwds, work=_convertfile, diagnose=False):
+    """
+    Process files given by `todo`, a list of `work` jobs. Conversions yield
+    diagnostics only if `diagnose` is true.
+
+    """
+    if jobs == 1 or len(todo) < 2:
+        _initworker(kwds, diagnose)
+        for job in todo:
+            yield work(job)
+        return
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs, _initworker, (kwds, diagnose))
+    try:
+        for result in pool.imap_unordered(work, todo):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# =============================================================================
+# incremental conversion
+# =============================================================================
+
+MANIFEST = ".markowik-manifest.json"
+
+def handlername(handler):
+    """
+    Get the qualified name of a tag `handler` (see `Converter`), or `None` if
+    it can't be imported by its name (e.g. a lambda or a nested function).
+
+    >>> from markowik.util import logger
+    >>> handlername(logger), handlername(lambda *args: "")
+    ('markowik.util.logger', None)
+
+    """
+    name = getattr(handler, '__name__', None)
+    module = sys.modules.get(getattr(handler, '__module__', None))
+    if name is None or getattr(module, name, None) is not handler:
+        return None
+    return "%s.%s" % (handler.__module__, name)
+
+def optionskey(kwds):
+    """
+    Get a key for the effective conversion options given by `kwds`.
+
+    The key also covers the Markowik and PyMD versions, i.e. any change of
+    options or versions results in a different key. Returns `None` if tag
+    handlers can't be identified (see `handlername()`).
+
+    """
+    import inspect
+    import markdown
+
+    spec = inspect.getargspec(Converter.__init__)
+    opts = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    opts.update(kwds)
+    opts.pop('instrument') # does not affect the output
+    opts.pop('escapecache') # neither does this
+    opts.pop('treecache') # nor this
+    if opts['wikiwords'] not in (True, False):
+        opts['wikiwords'] = sorted(opts['wikiwords'])
+    opts['tags'] = sorted((k, handlername(v))
+                          for k, v in (opts['tags'] or {}).items())
+    if any(name is None for _, name in opts['tags']):
+        return None
+    opts['mx'] = extensionnames(opts['mx'])
+    opts['markowik'] = markowik.__version__
+    opts['markdown'] = markdown.version
+    return hashlib.sha1(json.dumps(opts, sort_keys=True)).hexdigest()
+
+def filekey(fname, optkey):
+    """Get a key for the content of file `fname` and an options key."""
+
+    sha = hashlib.sha1(optkey)
+    with open(fname, 'rb') as fp:
+        sha.update(fp.read())
+    return sha.hexdigest()
+
+def loadmanifest(outdir):
+    """
+    Load the manifest of previous conversions into `outdir`.
+
+    The manifest maps source file names (relative to the batch source) to
+    their last conversion key and output file (relative to `outdir`).
+
+    """
+    fname = os.path.join(outdir, MANIFEST)
+    try:
+        with open(fname) as fp:
+            return json.load(fp)['files']
+    except (IOError, ValueError, KeyError):
+        return {}
+
+def savemanifest(outdir, files):
+    """Save a manifest (see `loadmanifest()`)."""
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    fname = os.path.join(outdir, MANIFEST)
+    with open("%s.tmp" % fname, 'w') as fp:
+        json.dump({'files': files}, fp, indent=1, sort_keys=True)
+    os.rename("%s.tmp" % fname, fname)
+
+# =============================================================================
+
+def convert(source, outdir, jobs=None, force=False, report=None, log=None,
+            **kwds):
+    """
+    Convert all Markdown files in `source` to wiki files in `outdir`.
+
+    The source may be a directory or a glob pattern (directories are searched
+    for HTML files instead when using the ``html`` frontend). Its layout is
+    mirrored in `outdir` with `.wiki` file extensions. Files are converted by
+    `jobs` worker processes (default: number of CPUs), other keyword
+    arguments are passed to `Converter`.
+
+    Conversions are incremental: files whose content and conversion options
+    did not change since their last conversion into `outdir` are skipped and
+    wiki files of removed sources are deleted. Set `force` to convert all
+    files anyway (which is implied when using tag handlers without a name,
+    see `handlername()`).
+
+    Yields an input file name and an error message (`None` on success) for
+    each converted file, in the order conversions finish. If given, `report`
+    gets called with the input file name and the conversion's diagnostics
+    (see `Converter.diagnostics()`) for each successfully converted file.
+    Skipped and removed files are reported to `log`, a function taking a
+    message, if given (see `markowik.util.logger()`).
+
+    """
+    optkey = optionskey(kwds)
+    force = force or optkey is None
+    previous = loadmanifest(outdir)
+    current = {}
+
+    todo = []
+    sources = collect(source, extensions(kwds))
+    for infile, relname in sources:
+        key = optkey and filekey(infile, optkey)
+        outfile = wikiname(outdir, relname)
+        entry = {'key': key, 'output': os.path.relpath(outfile, outdir)}
+        unchanged = previous.get(relname) == entry and os.path.exists(outfile)
+        if unchanged and not force:
+            current[relname] = entry
+        else:
+            todo.append(((infile, outfile), relname, entry))
+
+    log = log or (lambda msg: None)
+    log("skipping %d unchanged file(s)" % len(current))
+
+    # remove wiki files of sources which are gone
+    base = basedir(source)
+    relnames = set(x[1] for x in sources)
+    for relname, entry in previous.items():
+        if relname in relnames:
+            continue
+        if os.path.exists(os.path.join(base, relname)):
+            current[relname] = entry # not matched by `source` this time
+            continue
+        outfile = os.path.join(outdir, entry['output'])
+        if os.path.exists(outfile):
+            log("removing obsolete wiki file '%s'" % outfile)
+            os.remove(outfile)
+
+    byinfile = dict((job[0], (relname, entry)) for job, relname, entry in todo)
+    if not jobs:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    try:
+        for infile, error, diagnostics in _run([x[0] for x in todo], jobs,
+                                               kwds, diagnose=bool(report)):
+            if not error:
+                relname, entry = byinfile[infile]
+                current[relname] = entry
+                if report:
+                    report(infile, diagnostics)
+            yield infile, error
+    finally:
+        savemanifest(outdir, current)
+
+def validate(source, jobs=None, **kwds):
+    """
+    Find conversion problems in all Markdown files in `source`.
+
+    The source may be a directory or a glob pattern, `jobs` and other keyword
+    arguments are used like in `convert()`. Yields an input file name, the
+    problems found, and an error message (`None` if the file could be
+    validated) for each file, in the order validations finish.
+
+    """
+    if not jobs:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    todo = [x[0] for x in collect(source, extensions(kwds))]
+    for result in _run(todo, jobs, kwds, _validatefile):
+        yield result
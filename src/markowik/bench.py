@@ -0,0 +1,697 @@
+"""
+Markowik performance benchmarks.
+
+Run ``markowik-bench`` (or ``python -m markowik.bench``) to time conversions
+of the test suite documents and of generated stress documents. Other
+benchmarks can be selected by name, see ``markowik-bench --help``.
+
+"""
+import argparse
+import codecs
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import markdown
+
+import markowik
+from markowik.main import convert, Converter, BadURL
+from markowik.incremental import IncrementalConverter
+from markowik.main import options, converteroptions
+from markowik.instrument import Stats
+from markowik.mdx import TagFormatter
+from markowik.util import escape, escapewikiwords
+
+# =============================================================================
+# helpers
+# =============================================================================
+
+SAMPLE = u"""
+A Title
+=======
+
+Some *markdown* text with a [link](http://foo.bar) and `code`.
+
+* a list item
+* another list item
+
+> a quote
+""".strip()
+
+def timeit(func, number):
+    """Run `func` `number` times and return the average time per run."""
+
+    t0 = time.time()
+    for _ in xrange(number):
+        func()
+    return (time.time() - t0) / number
+
+PHASES = ('parse', 'preprocessor', 'preprocess', 'convert', 'postprocess')
+
+def timewalk(converter):
+    """
+    Get a function which returns the accumulated tree walk (preprocessing and
+    conversion) time of an instrumented `converter`.
+
+    """
+    stats = converter.instrument
+    return lambda: (stats.timings.get('preprocess', 0.0) +
+                    stats.timings.get('convert', 0.0))
+
+def report(title, rows):
+    """
+    Print benchmark results `rows`, a list of name-seconds pairs.
+
+    Returns the results as a list of dictionaries.
+
+    """
+    print(title)
+    for name, secs in rows:
+        print("  %-50s %10.3f ms" % (name, secs * 1000))
+    return [{'name': name, 'seconds': secs} for name, secs in rows]
+
+# =============================================================================
+# benchmarks
+# =============================================================================
+
+def overhead(number=500):
+    """Per-document time of `convert()` vs. a reused `Converter`."""
+
+    converter = Converter()
+    rows = [
+        ("convert() (new PyMD instance per doc)",
+         timeit(lambda: convert(SAMPLE), number)),
+        ("Converter.convert() (reused instance)",
+         timeit(lambda: converter.convert(SAMPLE), number)),
+    ]
+    return report("Per-document time for a small document", rows)
+
+def scaling(number=3):
+    """Conversion time for a document scaled to 1x, 10x, and 100x its size."""
+
+    converter = Converter(instrument=Stats())
+    walk = timewalk(converter)
+
+    rows = []
+    for scale in (1, 10, 100):
+        src = "\n\n".join([SAMPLE] * 20 * scale)
+        t0 = walk()
+        secs = timeit(lambda: converter.convert(src), number)
+        name = "%3dx (%d KB)" % (scale, len(src) // 1024)
+        rows.append(("%s total" % name, secs))
+        rows.append(("%s tree walk" % name, (walk() - t0) / number))
+    return report("Conversion time by document size", rows)
+
+def editing(number=20):
+    """
+    Reconversion time for an edit of one paragraph in documents of different
+    sizes, converted at once vs. incrementally.
+
+    """
+    rows = []
+    for scale in (1, 10, 100):
+        blocks = [SAMPLE] * 20 * scale
+        original = "\n\n".join(blocks)
+        middle = len(blocks) // 2
+        versions = []
+        for i in xrange(number):
+            blocks[middle] = SAMPLE.replace("text", "text %d" % i)
+            versions.append("\n\n".join(blocks))
+        name = "%3dx (%d KB)" % (scale, len(versions[0]) // 1024)
+        converter = Converter()
+        incremental = IncrementalConverter()
+        incremental.convert(original)
+        for title, func in (("whole", converter.convert),
+                            ("incremental", incremental.convert)):
+            edits = iter(versions)
+            rows.append(("%s %s" % (name, title),
+                         timeit(lambda: func(next(edits)), number)))
+    return report("Reconversion time after a one-paragraph edit", rows)
+
+def frontends(number=3):
+    """
+    Conversion time for documents given as Markdown vs. pre-rendered XHTML
+    (as an HTML string or an element tree, see `markowik.frontend`).
+
+    """
+    from markdown.util import etree
+
+    rows = []
+    for scale in (1, 10, 100):
+        src = "\n\n".join([SAMPLE] * 20 * scale)
+        html = markdown.markdown(src)
+        xml = (u"<div>%s</div>" % html).encode('UTF8')
+        name = "%3dx (%d KB)" % (scale, len(src) // 1024)
+        converter = Converter()
+        htmlconverter = Converter(frontend='html')
+        rows += [
+            ("%s markdown" % name, timeit(lambda: converter.convert(src),
+                                          number)),
+            ("%s html" % name, timeit(lambda: htmlconverter.convert(html),
+                                      number)),
+            ("%s element tree" % name, timeit(lambda: converter.converttree(
+                etree.fromstring(xml)), number)),
+        ]
+    return report("Conversion time by input format", rows)
+
+ESCAPESAMPLE = (u"Use `FooBar.baz_qux()` with *args and [options] or "
+                u"{{{raw}}} text, see SomeClass_Name and x_y_z. ")
+
+def _multipassescape(text):
+    """Escaping as done before the single-pass `escape()`."""
+
+    text = escapewikiwords(text)
+    text = re.sub(r'`', u'\u0005', text)
+    text = re.sub(r'({{{|}}})', r'`\1`', text)
+    text = re.sub(u'\u0005', '{{{`}}}', text)
+    text = re.sub(r'([[\]_*])', r'`\1`', text)
+    return text
+
+def escaping(number=20000):
+    """Escaping text fragments with many special characters."""
+
+    rows = [
+        ("multi-pass escaping", timeit(lambda: _multipassescape(ESCAPESAMPLE),
+                                       number)),
+        ("single-pass escape()", timeit(lambda: escape(ESCAPESAMPLE), number)),
+        ("single-pass escape() on plain text",
+         timeit(lambda: escape(u"Some plain text " * 6), number)),
+    ]
+    return report("Time per escaped text fragment", rows)
+
+def treewalk(number=3):
+    """Tree walk time for documents with many list items or table cells."""
+
+    docs = [
+        ("5000 list items", "\n".join("* item %d" % i for i in xrange(5000))),
+        ("1000 nested list items", "\n".join(
+            "%s* item %d" % ("    " * (i % 10), i) for i in xrange(1000))),
+        ("2000 table rows", "a | b | c\n--|--|--\n" + "\n".join(
+            "%d | *x* | y" % i for i in xrange(2000))),
+    ]
+
+    converter = Converter(mx=['tables'], instrument=Stats())
+    walk = timewalk(converter)
+
+    rows = []
+    for name, src in docs:
+        t0 = walk()
+        timeit(lambda: converter.convert(src), number)
+        rows.append((name, (walk() - t0) / number))
+    return report("Tree walk time by document", rows)
+
+def nesting(number=3, lines=2000):
+    """Tree walk time for content nested in lists and blockquotes."""
+
+    converter = Converter(instrument=Stats())
+    walk = timewalk(converter)
+
+    rows = []
+    for depth in (1, 10, 30):
+        outline = "\n".join("%s* level %d" % ("    " * i, i)
+                             for i in xrange(depth))
+        outline += "\n" + "\n".join("%s* item *%d*" % ("    " * depth, i)
+                                    for i in xrange(lines))
+        thread = "\n".join("%s line *%d*  " % (">" * depth, i)
+                           for i in xrange(lines))
+        for name, src in (("list items", outline), ("quoted lines", thread)):
+            t0 = walk()
+            timeit(lambda: converter.convert(src), number)
+            rows.append(("%d %s at depth %d" % (lines, name, depth),
+                         (walk() - t0) / number))
+    return report("Tree walk time by nesting depth", rows)
+
+def apidocs(classes=200):
+    """A CamelCase-heavy API reference document."""
+
+    names = ["%sNode%s" % (x, y) for x in ("List", "Tree", "Text", "Link")
+             for y in ("Walker", "Builder", "Visitor", "Formatter", "Parser")]
+    sections = []
+    for i in xrange(classes):
+        name = names[i % len(names)]
+        rows = "\n".join(
+            "%s_%d | Returns a %s instance | See also %s" %
+            (method, j, names[(i + j) % len(names)], names[j % len(names)])
+            for j, method in enumerate(("getValue", "setValue", "toString",
+                                        "isEmpty", "addChild", "getParent")))
+        sections.append(
+            "%s\n%s\n\nThe %s class extends %s and implements NodeVisitor."
+            "\n\nMethod | Description | Related\n--|--|--\n%s\n\n"
+            "* Thread safety: a %s is not ThreadSafe\n"
+            "* Since: CoreLibrary 2.0" %
+            (name, "-" * len(name), name, names[(i + 1) % len(names)], rows,
+             name))
+    return "\n\n".join(sections), names
+
+def wikiwords(number=3):
+    """Escaping and conversion time of API docs with and without caching."""
+
+    src, names = apidocs()
+    configs = [
+        ("no escape cache", {'escapecache': 0}),
+        ("escape cache", {}),
+        ("escape cache, linked page names", {'wikiwords': names}),
+        ("no WikiWord escaping", {'wikiwords': False}),
+    ]
+
+    # record the text fragments escaped when converting the document
+    fragments = []
+    recorder = Converter(mx=['tables'])
+    escaper = recorder.tp.escape
+    recorder.tp.escape = lambda *args: fragments.append(args) or escaper(*args)
+    recorder.convert(src)
+
+    rows = []
+    for name, kwds in configs:
+        converter = Converter(mx=['tables'], **kwds)
+        escaper = converter.escaper
+        converter.convert(src) # warm up
+        cache = escaper.cache
+        if cache: # hit ratio within one document
+            name = "%s (%d%% hits)" % (name, cache.hits * 100 //
+                                       (cache.hits + cache.misses))
+        total = timeit(lambda: converter.convert(src), number)
+        escaping = timeit(lambda: [escaper(*x) for x in fragments], number)
+        rows.append(("%s: escaping" % name, escaping))
+        rows.append(("%s: total" % name, total))
+    return report("Time for %d KB of API docs (%d escaped fragments)" %
+                  (len(src) // 1024, len(fragments)), rows)
+
+class _GetattrFormatter(TagFormatter):
+    """Tag dispatch as done before the `TagFormatter.handlers` registry."""
+
+    def __getattr__(self, name):
+
+        if name in self.idletags:
+            return lambda _, text, *x: text
+        if name in self.htmlspanleveltags:
+            return lambda _, text, *x: '<%s>%s</%s>' % (name, text, name)
+
+        raise AttributeError(name)
+
+def dispatch(number=3):
+    """Handler lookup and conversion time for table- and span-heavy input."""
+
+    docs = [
+        ("tables", "\n\n".join(
+            "a | b | c\n--|--|--\n" + "\n".join("%d | x | y" % i
+                                               for i in xrange(20))
+            for _ in xrange(100))),
+        ("spans", "\n\n".join(
+            "Some *em*, **strong**, `code`, and [link](http://foo.bar) " * 20
+            for _ in xrange(100))),
+    ]
+
+    rows = []
+    for name, src in docs:
+        stats = Stats()
+        converter = Converter(mx=['tables'], instrument=stats)
+        tags = [x.tag for x in converter.parse(src).getiterator()]
+        legacy = _GetattrFormatter(converter.mdx)
+        handlers = TagFormatter(converter.mdx).handlers
+        lookup = lambda: [getattr(legacy, x) for x in tags]
+        rows.append(("%s: %d getattr() lookups" % (name, len(tags)),
+                     timeit(lookup, number * 10)))
+        lookup = lambda: [handlers[x] for x in tags]
+        rows.append(("%s: %d handlers lookups" % (name, len(tags)),
+                     timeit(lookup, number * 10)))
+        timeit(lambda: converter.convert(src), number)
+        rows.append(("%s: conversion phase" % name,
+                     stats.timings['convert'] / number))
+    return report("Tag handler dispatch time by document", rows)
+
+def resident(number=200):
+    """Latency and throughput of one-shot command line runs vs. a server."""
+
+    fd, fname = tempfile.mkstemp(suffix=".md")
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(SAMPLE)
+    cmd = [sys.executable, "-c", "from markowik.main import main; main()"]
+    devnull = open(os.devnull, 'w')
+    try:
+        oneshot = timeit(lambda: subprocess.check_call(cmd + [fname],
+                                                       stdout=devnull),
+                         max(number // 10, 1))
+    finally:
+        os.remove(fname)
+        devnull.close()
+
+    server = subprocess.Popen(cmd + ["serve"], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+    request = "%s\n" % json.dumps({'src': SAMPLE})
+
+    def roundtrip():
+        server.stdin.write(request)
+        server.stdin.flush()
+        server.stdout.readline()
+
+    roundtrip() # warm up
+    latency = timeit(roundtrip, number)
+
+    t0 = time.time() # pipelined requests
+    server.stdin.write(request * number)
+    server.stdin.flush()
+    for _ in xrange(number):
+        server.stdout.readline()
+    throughput = (time.time() - t0) / number
+
+    server.stdin.close()
+    server.wait()
+
+    rows = [
+        ("one-shot command line run", oneshot),
+        ("server request (round trip latency)", latency),
+        ("server request (pipelined throughput)", throughput),
+    ]
+    return report("Time per small document", rows)
+
+STARTUPMODULES = ('markowik', 'markowik.main', 'markowik.batch', 'argparse',
+                  'markowik.mdx', 'markdown')
+
+IMPORTTIME = """
+import sys, time
+t0, n = time.time(), len(sys.modules)
+import %s
+print time.time() - t0, len(sys.modules) - n
+"""
+
+def startup(number=10):
+    """
+    Command line startup time and import times of Markowik modules.
+
+    Import times are measured in a fresh interpreter for each module, i.e.
+    they include the import times of all dependencies (like the cumulative
+    times reported by ``python -X importtime`` in Python 3.7+).
+
+    """
+    fd, fname = tempfile.mkstemp(suffix=".md")
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(SAMPLE)
+    main = "from markowik.main import main; main()"
+    commands = [
+        ("interpreter startup", [sys.executable, "-c", "pass"]),
+        ("markowik --help", [sys.executable, "-c", main, "--help"]),
+        ("markowik FILE", [sys.executable, "-c", main, fname]),
+    ]
+    devnull = open(os.devnull, 'w')
+    try:
+        rows = [(name, min(timeit(lambda: subprocess.check_call(
+                 cmd, stdout=devnull), 1) for _ in xrange(number)))
+                for name, cmd in commands]
+    finally:
+        os.remove(fname)
+        devnull.close()
+
+    for module in STARTUPMODULES:
+        cmd = [sys.executable, "-c", IMPORTTIME % module]
+        times = [subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+                 for _ in xrange(number)]
+        secs, modules = min(tuple(float(x) for x in t.split()) for t in times)
+        rows.append(("import %s (%d modules)" % (module, modules), secs))
+
+    return report("Startup and import times", rows)
+
+# -----------------------------------------------------------------------------
+# corpus benchmark
+# -----------------------------------------------------------------------------
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "tests")
+
+def fixtures(path=FIXTURES):
+    """Get test suite documents in `path` (with their conversion options)."""
+
+    docs = []
+    for fname in sorted(glob.glob(os.path.join(path, "*.md"))):
+        with codecs.open(fname, 'r', 'UTF8') as fp:
+            src = fp.read()
+        cfgfile = "%s.cfg" % os.path.splitext(fname)[0]
+        args = []
+        if os.path.exists(cfgfile):
+            with codecs.open(cfgfile, 'r', 'UTF8') as fp:
+                args = [x.strip() for x in fp if x.strip()]
+        kwds = converteroptions(options([fname] + args))
+        try:
+            Converter(**kwds).convert(src)
+        except BadURL: # some test documents check bad URL errors
+            continue
+        docs.append((src, kwds))
+    return docs
+
+def deeplists(items=2000, depth=8):
+    """A document with deeply nested lists."""
+
+    lines = []
+    for i in xrange(items):
+        level = i % depth
+        marker = "*" if level % 2 else "1."
+        lines.append("%s%s item *%d* with `code`" % ("    " * level, marker, i))
+    return "\n".join(lines)
+
+def hugetable(rows=5000, cols=5):
+    """A document with a huge table."""
+
+    head = " | ".join("col %d" % i for i in xrange(cols))
+    rule = "|".join("--" for _ in xrange(cols))
+    body = ("\n".join(" | ".join("cell *%d*/%d" % (r, c) for c in xrange(cols))
+                      for r in xrange(rows)))
+    return "%s\n%s\n%s" % (head, rule, body)
+
+def linksandimages(count=3000):
+    """A document with lots of links and images."""
+
+    return "\n\n".join(
+        "See [link %d](http://foo.bar/%d), [page](WikiPage%d), and "
+        "![image %d](img/%d.png)." % (i, i, i, i, i) for i in xrange(count))
+
+def codeblocks(blocks=20, lines=2000):
+    """A document with long code blocks."""
+
+    code = "\n".join("    line %d: x = [y * 2 for y in range(%d)]" % (i, i)
+                     for i in xrange(lines))
+    return "\n\n".join("Block %d:\n\n%s" % (i, code) for i in xrange(blocks))
+
+def stressdocs():
+    """Get generated stress documents (with their conversion options)."""
+
+    return [
+        ("deep lists", [(deeplists(), {})]),
+        ("huge table", [(hugetable(), {'mx': ['tables']})]),
+        ("links and images", [(linksandimages(),
+                               {'imagebaseurl': "http://img.foo.bar/"})]),
+        ("long code blocks", [(codeblocks(), {})]),
+        ("prose", [("\n\n".join([SAMPLE] * 500), {})]),
+    ]
+
+def corpus(number=3, path=FIXTURES):
+    """
+    Convert test suite documents and generated stress documents.
+
+    For each document group, reports the number of documents, the size, the
+    throughput, and the time spent in each conversion phase.
+
+    """
+    groups = stressdocs()
+    docs = fixtures(path)
+    if docs:
+        groups.insert(0, ("test suite", docs))
+
+    results = []
+    print("Conversion throughput and time per phase (ms per iteration)")
+    print("  %-18s %5s %8s %8s %7s %s" % (
+        "documents", "count", "KB", "docs/s", "MB/s",
+        " ".join("%12s" % x for x in PHASES)))
+
+    for name, docs in groups:
+
+        stats = Stats()
+        converters = {}
+        for _, kwds in docs:
+            key = repr(sorted(kwds.items()))
+            if key not in converters:
+                converters[key] = Converter(instrument=stats, **kwds)
+        jobs = [(converters[repr(sorted(k.items()))], src) for src, k in docs]
+
+        def run():
+            for converter, src in jobs:
+                converter.convert(src)
+
+        secs = timeit(run, number)
+        size = sum(len(src.encode('UTF8')) for src, _ in docs)
+        result = {
+            'name': name,
+            'docs': len(docs),
+            'bytes': size,
+            'seconds': secs,
+            'docs_per_sec': len(docs) / secs,
+            'mb_per_sec': size / secs / 1024 / 1024,
+            'phases': dict((x, stats.timings.get(x, 0.0) / number)
+                           for x in PHASES),
+            'counters': dict((k, v // number)
+                             for k, v in stats.counters.items()),
+        }
+        results.append(result)
+        print("  %-18s %5d %8d %8.1f %7.3f %s" % (
+            name, len(docs), size // 1024, result['docs_per_sec'],
+            result['mb_per_sec'], " ".join("%12.1f" % (result['phases'][x] *
+                                                       1000) for x in PHASES)))
+
+    return results
+
+def validation(number=3):
+    """Validation vs. conversion time of the stress documents."""
+
+    rows = []
+    for name, docs in stressdocs():
+        for src, kwds in docs:
+            converter = Converter(**kwds)
+            rows.append(("%s: convert" % name,
+                         timeit(lambda: converter.convert(src), number)))
+            rows.append(("%s: validate" % name,
+                         timeit(lambda: converter.validate(src), number)))
+    return report("Validation vs. conversion time by document", rows)
+
+def parallel(number=3):
+    """Conversion time of big multi-block documents by number of jobs."""
+
+    docs = [
+        ("API docs", apidocs(1000)[0], {'mx': ['tables']}),
+        ("prose", "\n\n".join([SAMPLE] * 500), {}),
+        ("links and images", "\n\n".join([linksandimages(300)] * 10),
+         {'imagebaseurl': "http://img.foo.bar/"}),
+    ]
+
+    rows = []
+    for name, src, kwds in docs:
+        for jobs in (1, 2, 4):
+            converter = Converter(jobs=jobs, **kwds)
+            rows.append(("%s: %d job(s)" % (name, jobs),
+                         timeit(lambda: converter.convert(src), number)))
+    return report("Conversion time by number of jobs (%d CPUs)" %
+                  multiprocessing.cpu_count(), rows)
+
+MEMORY = """
+import io, sys, time
+from markowik import stream, util
+from markowik.main import Converter
+converter = Converter(mx=['tables'])
+t0 = time.time()
+if sys.argv[2] == 'stream':
+    pieces = stream.iterconvert(converter, sys.argv[1])
+else:
+    with io.open(sys.argv[1], encoding='UTF8') as fp:
+        pieces = converter.iterconvert(fp.read())
+for wiki in pieces:
+    pass
+print time.time() - t0, util.peakmemory() or 0
+"""
+
+def streaming(number=1, size=5):
+    """
+    Conversion time and peak memory usage of a big document (`size` MB),
+    converted at once vs. segment by segment.
+
+    Each conversion runs in a fresh interpreter, i.e. peak memory usage
+    includes the interpreter and imported modules.
+
+    """
+    src = apidocs(100)[0]
+    src = "\n\n".join([src] * (size * 1048576 // len(src) + 1))
+    fd, fname = tempfile.mkstemp(suffix=".md")
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(src.encode('UTF8'))
+    del src
+
+    rows, memory = [], []
+    try:
+        for mode in ('whole', 'stream'):
+            cmd = [sys.executable, "-c", MEMORY, fname, mode]
+            runs = [subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                    .communicate()[0] for _ in xrange(number)]
+            secs, peak = min(tuple(float(x) for x in r.split()) for r in runs)
+            rows.append(("%s (peak memory %.1f MB)" % (mode, peak / 1048576),
+                         secs))
+            memory.append(peak)
+    finally:
+        os.remove(fname)
+
+    results = report("Conversion of a %d MB document" % size, rows)
+    for result, peak in zip(results, memory):
+        result['peakmemory'] = peak
+    return results
+
+# =============================================================================
+
+BENCHMARKS = {
+    'corpus': corpus,
+    'dispatch': dispatch,
+    'editing': editing,
+    'escaping': escaping,
+    'frontends': frontends,
+    'nesting': nesting,
+    'overhead': overhead,
+    'parallel': parallel,
+    'resident': resident,
+    'scaling': scaling,
+    'startup': startup,
+    'streaming': streaming,
+    'treewalk': treewalk,
+    'validation': validation,
+    'wikiwords': wikiwords,
+}
+
+# =============================================================================
+# command line interface
+# =============================================================================
+
+def main():
+
+    desc = """
+        Run Markowik benchmarks. By default, only the corpus benchmark is run,
+        which converts the test suite documents and generated stress
+        documents.
+    """
+
+    p = argparse.ArgumentParser(prog="markowik-bench", description=desc)
+    p.add_argument('names', metavar='NAME', nargs='*',
+                   help="benchmarks to run (default: corpus, choose from %s)"
+                   % ", ".join(sorted(BENCHMARKS)))
+    p.add_argument('--number', metavar='N', type=int, default=None,
+                   help="number of iterations (default: benchmark specific)")
+    p.add_argument('--fixtures', metavar='DIR', default=FIXTURES,
+                   help="directory with test suite documents for the corpus "
+                   "benchmark (default: %(default)s)")
+    p.add_argument('--json', metavar='FILE', default=None,
+                   help="also write results as JSON to FILE")
+    opts = p.parse_args()
+
+    for name in opts.names:
+        if name not in BENCHMARKS:
+            p.error("unknown benchmark: %s" % name)
+
+    results = {}
+    for name in opts.names or ['corpus']:
+        kwds = {'number': opts.number} if opts.number else {}
+        if name == 'corpus':
+            kwds['path'] = opts.fixtures
+        results[name] = BENCHMARKS[name](**kwds)
+
+    if opts.json:
+        report = {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'markdown': markdown.version,
+            'markowik': markowik.__version__,
+            'benchmarks': results,
+        }
+        with open(opts.json, 'w') as fp:
+            json.dump(report, fp, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
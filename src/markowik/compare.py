@@ -0,0 +1,291 @@
+"""
+Differential comparison of Markowik versions or configurations.
+
+Converts a corpus of Markdown documents with two *sides*, a baseline and a
+candidate, diffs the wiki text page by page, and compares conversion times.
+Pages whose wiki text changed or whose conversion got slower than a given
+threshold are flagged. Run ``markowik-compare --help`` for usage.
+
+A side is a Markowik (and PyMD) installation, given by a Python interpreter
+and some paths to prepend to its module search path, and a configuration,
+given by command line options. Each side converts documents in a separate
+process which imports Markowik from its installation and handles requests
+line by line, similar to ``markowik serve``. Conversion times are measured
+within that process, i.e. they do not include any communication overhead.
+
+"""
+import argparse
+import codecs
+import difflib
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+from markowik import batch
+from markowik.main import options, converteroptions
+
+# =============================================================================
+# sides
+# =============================================================================
+
+# Runs in a side's process and works with any Markowik version which provides
+# `markowik.convert()` (using a `Converter` if available). Each request is a
+# JSON object with the keys `src`, `options`, and `number`, each response one
+# with the keys `wiki` and `seconds` (the fastest of `number` conversions) or
+# `error`.
+DRIVER = r"""
+import json, sys, time
+sys.path[:0] = json.loads(sys.argv[1])
+import markowik
+converters = {}
+def converter(options):
+    key = json.dumps(options, sort_keys=True)
+    if key not in converters:
+        if hasattr(markowik, 'Converter'):
+            converters[key] = markowik.Converter(**options).convert
+        else:
+            converters[key] = lambda src: markowik.convert(src, **options)
+    return converters[key]
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    options = dict((str(k), v) for k, v in request['options'].items())
+    try:
+        convert = converter(options)
+        wiki = convert(request['src'])
+        times = []
+        for _ in range(request['number']):
+            t0 = time.time()
+            convert(request['src'])
+            times.append(time.time() - t0)
+        response = {'wiki': wiki, 'seconds': min(times or [0.0])}
+    except Exception as e:
+        try:
+            msg = unicode(e)
+        except UnicodeError:
+            msg = repr(e)
+        response = {'error': u'%s: %s' % (type(e).__name__, msg)}
+    sys.stdout.write(json.dumps(response) + '\n')
+    sys.stdout.flush()
+"""
+
+# the installation of this module, used by default
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Side(object):
+    """
+    A Markowik installation and configuration to convert documents with.
+
+    The installation is given by paths to prepend to the module search path
+    (default: the installation of this module) and a Python interpreter
+    (default: the current one). The configuration is given by a list of
+    command line arguments (`args`).
+
+    """
+    def __init__(self, name, paths=None, python=None, args=None):
+        self.name = name
+        self.paths = [os.path.abspath(x) for x in paths or [HERE]]
+        self.python = python or sys.executable
+        self.args = list(args or [])
+        self.proc = None
+
+    def start(self):
+        """Start the process converting documents."""
+
+        self.proc = subprocess.Popen(
+            [self.python, "-c", DRIVER, json.dumps(self.paths)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self):
+        """Stop the process converting documents."""
+
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+    def convert(self, src, args, number):
+        """
+        Convert Markdown source `src` with additional command line `args`.
+
+        Returns the wiki text and the fastest of `number` conversion times,
+        or `None` and an error message.
+
+        """
+        kwds = converteroptions(options(["-"] + args + self.args))
+        request = {'src': src, 'options': kwds, 'number': number}
+        self.proc.stdin.write("%s\n" % json.dumps(request))
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError("%s: conversion process died" % self.name)
+        response = json.loads(line)
+        if 'error' in response:
+            return None, response['error']
+        return response['wiki'], response['seconds']
+
+# =============================================================================
+# comparison
+# =============================================================================
+
+def readargs(fname):
+    """Read command line arguments from a file, one per line (if it exists)."""
+
+    if not os.path.exists(fname):
+        return []
+    with codecs.open(fname, 'r', 'UTF8') as fp:
+        return [x.strip() for x in fp if x.strip()]
+
+def compare(source, baseline, candidate, number=3, threshold=1.2, minms=1.0):
+    """
+    Compare conversions of all Markdown files in `source` by two sides.
+
+    The source may be a directory or a glob pattern (see
+    `markowik.batch.collect()`). Documents may have a `.cfg` file next to
+    them with additional command line arguments, one per line (like the test
+    suite documents). Conversion times are the fastest of `number` runs.
+
+    Yields a dictionary for each document, with its name (relative to the
+    source), its status (``same``, ``changed``, or ``error``), the times in
+    milliseconds for each side, their ratio, whether the candidate got slower
+    than `threshold` times the baseline (ignoring pages both sides convert in
+    less than `minms` milliseconds), and a unified diff of the wiki texts.
+
+    """
+    for side in (baseline, candidate):
+        side.start()
+    try:
+        for fname, relname in batch.collect(source):
+            with codecs.open(fname, 'r', 'UTF8') as fp:
+                src = fp.read()
+            args = readargs("%s.cfg" % os.path.splitext(fname)[0])
+            a, atime = baseline.convert(src, args, number)
+            b, btime = candidate.convert(src, args, number)
+            result = {'name': relname, 'diff': []}
+            if a is None or b is None:
+                result['status'] = 'error'
+                result['errors'] = [atime if a is None else None,
+                                    btime if b is None else None]
+                result['ms'] = [None, None]
+                result['ratio'] = None
+                result['slower'] = False
+            else:
+                result['status'] = 'same' if a == b else 'changed'
+                if a != b:
+                    result['diff'] = list(difflib.unified_diff(
+                        (a + "\n").splitlines(True),
+                        (b + "\n").splitlines(True),
+                        fromfile="%s (%s)" % (relname, baseline.name),
+                        tofile="%s (%s)" % (relname, candidate.name)))
+                result['ms'] = [atime * 1000, btime * 1000]
+                result['ratio'] = btime / atime if atime else None
+                result['slower'] = bool(
+                    max(result['ms']) >= minms and
+                    btime > atime * threshold)
+            yield result
+    finally:
+        for side in (baseline, candidate):
+            side.stop()
+
+def report(results, threshold, showdiff=False, fp=None):
+    """
+    Print `compare()` results to `fp` (default: stdout).
+
+    Returns the number of flagged (changed, slower, or failed) pages.
+
+    """
+    fp = fp or sys.stdout
+    fp.write("%-40s %12s %12s %7s  %s\n" % ("page", "baseline ms",
+                                            "candidate ms", "ratio", "flags"))
+    counts = {'changed': 0, 'slower': 0, 'error': 0}
+    flagged = 0
+    for result in results:
+        flags = []
+        if result['status'] != 'same':
+            flags.append(result['status'])
+        if result['slower']:
+            flags.append('slower')
+        for flag in flags:
+            counts[flag] += 1
+        flagged += bool(flags)
+        ms = ["%12.2f" % x if x is not None else "%12s" % "-"
+              for x in result['ms']]
+        ratio = result['ratio']
+        fp.write("%-40s %s %s %7s  %s\n" % (
+            result['name'], ms[0], ms[1],
+            "%.2f" % ratio if ratio is not None else "-", " ".join(flags)))
+        for error in result.get('errors') or []:
+            if error:
+                fp.write("    %s\n" % error.encode('UTF8'))
+        if showdiff:
+            for line in result['diff']:
+                fp.write(line.encode('UTF8'))
+    fp.write("%d page(s) flagged: %d changed, %d slower (by more than "
+             "%d%%), %d failed\n" % (flagged, counts['changed'],
+                                     counts['slower'],
+                                     round((threshold - 1) * 100),
+                                     counts['error']))
+    return flagged
+
+# =============================================================================
+# command line interface
+# =============================================================================
+
+def main(args=None):
+
+    desc = """
+        Convert a corpus of Markdown documents with a baseline and a candidate
+        Markowik version or configuration, compare the wiki text page by page,
+        and flag pages which changed or whose conversion got slower.
+    """
+
+    p = argparse.ArgumentParser(description=desc)
+    p.add_argument('source', metavar='CORPUS',
+                   help="directory or glob pattern of markdown files")
+    for side in ('baseline', 'candidate'):
+        p.add_argument('--%s' % side, metavar='PATH', nargs='+', default=None,
+                       help="paths to prepend to the module search path to "
+                       "import the %s Markowik and PyMD versions (default: "
+                       "this Markowik installation)" % side)
+        p.add_argument('--%s-python' % side, metavar='PYTHON', default=None,
+                       help="Python interpreter to run the %s with (default: "
+                       "the current one)" % side)
+        p.add_argument('--%s-args' % side, metavar='ARGS', default="",
+                       help="markowik command line options for the %s, "
+                       "given as one string (use --%s-args=ARGS if it starts "
+                       "with a dash)" % (side, side))
+    p.add_argument('--number', metavar='N', type=int, default=3,
+                   help="conversions per page and side to time, the fastest "
+                   "one counts (default: %(default)s)")
+    p.add_argument('--threshold', metavar='RATIO', type=float, default=1.2,
+                   help="flag pages which take more than RATIO times as long "
+                   "with the candidate (default: %(default)s)")
+    p.add_argument('--min-ms', metavar='MS', type=float, default=1.0,
+                   dest='minms',
+                   help="do not flag pages converted faster than this by both "
+                   "sides (default: %(default)s)")
+    p.add_argument('--diff', default=False, action='store_true',
+                   help="show differences of changed pages")
+    p.add_argument('--json', metavar='FILE', default=None,
+                   help="also save results as JSON to FILE")
+    opts = p.parse_args(args)
+
+    sides = [Side(x, getattr(opts, x), getattr(opts, "%s_python" % x),
+                  shlex.split(getattr(opts, "%s_args" % x)))
+             for x in ('baseline', 'candidate')]
+    for side in sides:
+        options(["-"] + side.args) # exits with a usage message if invalid
+
+    results = list(compare(opts.source, sides[0], sides[1], opts.number,
+                           opts.threshold, opts.minms))
+    flagged = report(results, opts.threshold, opts.diff)
+
+    if opts.json:
+        with open(opts.json, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+    sys.exit(1 if flagged else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Markowik exceptions and diagnostics.
+
+These live in a module of their own which does not depend on PyMD, i.e. they
+can be imported without loading PyMD.
+
+"""
+from collections import namedtuple
+
+from markowik.util import sanitize, truncate
+
+# =============================================================================
+
+class BadURL(Exception):
+    """
+    Indicates an invalid or missing protocol in a URL.
+
+    """
+    def __init__(self, url):
+        msg = ("the URL '%s' has an invalid or missing protocol prefix (must "
+               "be one of http, https, or ftp)" % url)
+        super(BadURL, self).__init__(msg)
+        self.url = url
+
+class UnknownTag(Exception):
+    """
+    Indicates an element which has no handler to convert it to wiki syntax.
+
+    """
+    def __init__(self, tag):
+        msg = ("don't know how to convert <%s> elements (use the `tags` "
+               "option to register a handler)" % tag)
+        super(UnknownTag, self).__init__(msg)
+        self.tag = tag
+
+def message(e):
+    """
+    Get the message of exception `e` as unicode string.
+
+    >>> message(BadURL(u"f\\xf6\\xf6"))[:13]
+    u"the URL 'f\\xf6\\xf6'"
+
+    """
+    try:
+        return unicode(e)
+    except UnicodeError:
+        return unicode(str(e), 'UTF8', 'replace')
+
+# =============================================================================
+
+class Diagnostic(namedtuple('Diagnostic', 'line kind subject')):
+    """
+    Something worth to know about the conversion of a document.
+
+    Diagnostics are problems found when validating a document (see
+    `Converter.validate()`) and notes about how elements have been converted
+    (see `Converter.diagnostics()`).
+
+    The `line` is the document's line number (starting at 1) the diagnostic
+    refers to, or `None` if unknown. The `kind` is one of the keys of
+    `Diagnostic.MESSAGES`, the `subject` a URL, tag, or text fragment it is
+    about. Messages are formatted only on demand:
+
+    >>> d = Diagnostic(3, 'html link', 'http://foo.bar')
+    >>> print d.message
+    using an HTML link for 'http://foo.bar' (it contains images or brackets)
+    >>> print Diagnostic(None, 'abbr', 'HyperText Markup Language').message
+    replacing <abbr> by <span> ('HyperText Ma...')
+
+    """
+    __slots__ = ()
+
+    MESSAGES = {
+        'bad url': None, # see `BadURL`
+        'unknown tag': None, # see `UnknownTag`
+        'nested paragraph': "using <br/> to fake nested paragraph '%s'",
+        'html link': ("using an HTML link for '%s' (it contains images or "
+                      "brackets)"),
+        'image extension': "appending artificial image file extension (%s)",
+        'abbr': "replacing <abbr> by <span> ('%s')",
+    }
+
+    # kinds which are not a problem
+    NOTES = frozenset(['abbr'])
+
+    # kinds whose subject is a text fragment
+    TEXTS = frozenset(['nested paragraph', 'abbr'])
+
+    @property
+    def message(self):
+        if self.kind == 'bad url':
+            return message(BadURL(self.subject))
+        if self.kind == 'unknown tag':
+            return message(UnknownTag(self.subject))
+        subject = self.subject
+        if self.kind in self.TEXTS:
+            subject = truncate(sanitize(subject or "..."), 15)
+        return self.MESSAGES[self.kind] % subject
+
+def summarize(diagnostics):
+    """
+    Summarize `diagnostics` by counting them per kind.
+
+    >>> summarize([Diagnostic(1, 'abbr', 'foo'), Diagnostic(7, 'abbr', 'bar'),
+    ...            Diagnostic(3, 'html link', 'http://foo.bar')])
+    'abbr (2), html link (1)'
+
+    """
+    counts = {}
+    for diagnostic in diagnostics:
+        counts[diagnostic.kind] = counts.get(diagnostic.kind, 0) + 1
+    return ", ".join("%s (%d)" % x for x in sorted(counts.items()))
@@ -0,0 +1,468 @@
+"""
+Frontends which get the XHTML element tree of a document without PyMD.
+
+Markowik converts the element tree of a document to wiki text, and PyMD's
+parser is just one way to get that tree. Documents already rendered to XHTML
+by another (e.g. faster) Markdown processor may be given as an HTML string
+(see `parsehtml()`) or as an element tree (see `adopt()`) instead, which
+skips parsing Markdown altogether (see `Converter.converttree()` and the
+converter option `frontend`).
+
+Given PyMD's XHTML output, the wiki text is the same as when converting the
+Markdown source, except for raw HTML in the source: elements known to
+Markowik (e.g. links or emphasis) are converted even if they were written as
+HTML. Like raw HTML in Markdown, other elements are kept as they are --
+block-level elements as a whole, span-level elements by their start and end
+tags (their content is converted). References to characters other than XML's
+special characters (e.g. ``&copy;``) are kept too.
+
+"""
+import cgi
+import htmlentitydefs
+import re
+
+from HTMLParser import HTMLParser
+
+from markdown.util import etree, isBlockLevel
+
+from markowik.mdx import tocomat
+
+# =============================================================================
+
+# elements without content (and end tag) in HTML
+VOIDTAGS = frozenset("""
+area base br col embed hr img input keygen link meta param source track wbr
+""".split())
+
+# references to these characters are replaced by the characters
+XMLCHARS = frozenset(u"<>&\"'")
+
+DOCUMENTTAGS = frozenset(('html', 'head', 'body'))
+
+ENTITIES = dict(htmlentitydefs.name2codepoint, apos=39) # XHTML's
+
+# HTML which can't be parsed as XML (or would be parsed differently)
+RXNOTXML = re.compile(r'&(?!(?:lt|gt|amp|quot|apos);)|<!')
+
+# the declaration of an XHTML file (which has been decoded already)
+RXXMLDECL = re.compile(r'\s*<\?xml\s[^>]*\?>')
+
+XHTMLNS = "{http://www.w3.org/1999/xhtml}"
+
+def unqualify(root):
+    """
+    Remove the XHTML namespace from the tags of the element tree `root`.
+
+    >>> root = etree.fromstring('<div xmlns="http://www.w3.org/1999/xhtml">'
+    ...                         '<p>x</p></div>')
+    >>> unqualify(root)
+    >>> [node.tag for node in root.iter()]
+    ['div', 'p']
+
+    """
+    stack = [root] # not `root.iter()`, which is recursive
+    while stack:
+        node = stack.pop()
+        tag = node.tag
+        if isinstance(tag, basestring) and tag.startswith(XHTMLNS):
+            node.tag = tag[len(XHTMLNS):]
+        stack.extend(node)
+
+def knowntags(formatter):
+    """Get the tags known to Markowik, given a `TagFormatter`."""
+
+    return set(formatter.handlers) | set(formatter.writers) | set(['abbr'])
+
+def starttag(tag, attrib, empty=False):
+    """
+    Get the start tag of an element as HTML.
+
+    >>> starttag('b', {'title': 'A "b"'}), starttag('input', {}, True)
+    ('<b title="A &quot;b&quot;">', '<input />')
+
+    """
+    attrs = "".join(' %s="%s"' % (k, cgi.escape(v, True))
+                    for k, v in sorted(attrib.items()))
+    return "<%s%s%s>" % (tag, attrs, " /" if empty else "")
+
+def addtext(node, index, text):
+    """Add `text` to the content of `node`, before its child at `index`."""
+
+    if index:
+        node[index - 1].tail = (node[index - 1].tail or "") + text
+    else:
+        node.text = (node.text or "") + text
+
+BLANKS = " \t\r\n" # whitespace in HTML (non-breaking space is not)
+
+RXTRAILINGBREAK = re.compile(r'[ \t\r]*\n[ \t\r\n]*\Z')
+
+def isblank(text):
+    """Check if `text` is whitespace only."""
+
+    return not (text or "").strip(BLANKS)
+
+def dropblanks(root):
+    """
+    Drop whitespace in the tree `root` which is next to block-level elements,
+    at the start of their content, or at its end if it contains a line break.
+
+    That's where (X)HTML has line breaks or indentation which PyMD's element
+    trees do not have.
+
+    >>> root = etree.fromstring("<div>\\n  <p> foo <b>bar</b>\\n  </p>\\n</div>")
+    >>> dropblanks(root)
+    >>> etree.tostring(root)
+    '<div><p>foo <b>bar</b></p></div>'
+
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.tag == 'pre':
+            continue
+        block = node is root or isBlockLevel(node.tag)
+        if block and node.text:
+            node.text = node.text.lstrip(BLANKS)
+        if len(node) and isblank(node.text) and isBlockLevel(node[0].tag):
+            node.text = None
+        for i, child in enumerate(node):
+            nextchild = node[i + 1] if i + 1 < len(node) else None
+            nextblock = (block if nextchild is None else
+                         isBlockLevel(nextchild.tag))
+            if isblank(child.tail) and (nextblock or isBlockLevel(child.tag)):
+                child.tail = None
+            stack.append(child)
+        if block and len(node) and node[-1].tail:
+            node[-1].tail = RXTRAILINGBREAK.sub("", node[-1].tail)
+        elif block and node.text and not len(node):
+            node.text = RXTRAILINGBREAK.sub("", node.text)
+
+def tocs(root, md):
+    """
+    Replace Markowik's ``[TOC]`` markers (see `markowik.mdx.tocomat()`) in
+    top-level paragraphs of the tree `root` by placeholders for raw HTML,
+    stashed in the PyMD instance `md`.
+
+    """
+    for node in root:
+        if node.tag == 'p' and not len(node) and node.text:
+            toc = tocomat(node.text)
+            if toc != node.text:
+                node.text = md.htmlStash.store(toc)
+
+# =============================================================================
+
+def adopt(root, md, known):
+    """
+    Prepare an XHTML element tree given by `root` for conversion.
+
+    Elements whose tag is not in `known` (see `knowntags()`) are replaced by
+    placeholders for raw HTML, stashed in the PyMD instance `md` (just like
+    PyMD does for raw HTML in Markdown). Comments and processing instructions
+    are dropped, ``[TOC]`` markers are replaced (see `tocs()`). The tree is
+    modified in place.
+
+    >>> import markdown
+    >>> md = markdown.Markdown()
+    >>> root = etree.fromstring("<div><p>A <b>bold <em>move</em></b></p>"
+    ...                         "<aside>Note</aside></div>")
+    >>> adopt(root, md, ['p', 'em'])
+    >>> [str(html) for html, _ in md.htmlStash.rawHtmlBlocks]
+    ['<aside>Note</aside>', '<b>', '</b>']
+    >>> print etree.tostring(root).replace("\\x02", "{").replace("\\x03", "}")
+    <div><p>A {wzxhzdk:1}bold <em>move</em>{wzxhzdk:2}</p><p>{wzxhzdk:0}</p></div>
+
+Unknown elements nested in unknown span-level elements are replaced too:
+
+    >>> root = etree.fromstring("<div><p><b><u>x <kbd>y</kbd></u></b></p></div>")
+    >>> adopt(root, md, ['p'])
+    >>> [str(html) for html, _ in md.htmlStash.rawHtmlBlocks[3:]]
+    ['<b>', '</b>', '<u>', '</u>', '<kbd>', '</kbd>']
+    >>> len(root.find('p'))
+    0
+
+    """
+    stash = md.htmlStash
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        i = 0
+        while i < len(node):
+            child = node[i]
+            tag = child.tag
+            if isinstance(tag, basestring) and tag in known:
+                stack.append(child)
+                i += 1
+                continue
+            node.remove(child)
+            tail = child.tail or ""
+            if not isinstance(tag, basestring): # comment or PI
+                addtext(node, i, tail)
+            elif isBlockLevel(tag):
+                child.tail = None
+                placeholder = stash.store(md.serializer(child))
+                if node is root: # a raw HTML block, like in Markdown
+                    p = etree.Element('p')
+                    p.text, p.tail = placeholder, tail
+                    node.insert(i, p)
+                    i += 1
+                else:
+                    addtext(node, i, placeholder + tail)
+            elif tag in VOIDTAGS and not len(child) and not child.text:
+                addtext(node, i, stash.store(starttag(tag, child.attrib,
+                                                      True)) + tail)
+            else: # keep the content, between the raw start and end tags
+                addtext(node, i, stash.store(starttag(tag, child.attrib)) +
+                        (child.text or ""))
+                for j, grandchild in enumerate(child):
+                    node.insert(i + j, grandchild)
+                addtext(node, i + len(child), stash.store("</%s>" % tag) + tail)
+                # hoisted children get checked next, they may be unknown too
+
+    dropblanks(root)
+    tocs(root, md)
+
+# =============================================================================
+
+class TreeBuilder(HTMLParser):
+    """
+    Builds an XHTML element tree from HTML (see `parsehtml()`).
+
+    """
+    def __init__(self, md, known):
+        HTMLParser.__init__(self)
+        self.md = md
+        self.known = known
+        self.root = etree.Element('div')
+        # open elements, by tag (unknown span-level elements have no element)
+        self.open = [('div', self.root)]
+        self.raw = None # pieces of a raw HTML block, while in one
+        self.rawopen = [] # open elements in a raw HTML block, by tag
+        self.inhead = False
+        self.meta = {}
+
+    @property
+    def node(self):
+        """The innermost open element."""
+
+        return next(node for _, node in reversed(self.open) if node is not None)
+
+    def addtext(self, text):
+        """Add `text` to the innermost open element."""
+
+        node = self.node
+        addtext(node, len(node), text)
+
+    def addblock(self, html):
+        """Add a raw HTML block."""
+
+        placeholder = self.md.htmlStash.store(html)
+        if self.node is self.root: # like in Markdown
+            etree.SubElement(self.root, 'p').text = placeholder
+        else:
+            self.addtext(placeholder)
+
+    def addraw(self, html):
+        """Add raw span-level HTML."""
+
+        self.addtext(self.md.htmlStash.store(html))
+
+    def closeimplied(self, tag):
+        """
+        Close a paragraph or list item left open (in sloppy HTML) when the
+        next one starts.
+
+        Other elements are not closed implicitly, e.g. XHTML may have block
+        level elements within paragraphs (raw HTML in Markdown).
+
+        """
+        if tag not in ('p', 'li'):
+            return
+        for i in xrange(len(self.open) - 1, 0, -1):
+            opentag = self.open[i][0]
+            if opentag == tag:
+                del self.open[i:]
+                return
+            if isBlockLevel(opentag) and not (tag == 'li' and opentag == 'p'):
+                return
+
+    def handle_starttag(self, tag, attrs, empty=False):
+
+        if self.raw is not None:
+            self.raw.append(self.get_starttag_text())
+            if not empty and tag not in VOIDTAGS:
+                self.rawopen.append(tag)
+            return
+        if tag in DOCUMENTTAGS:
+            self.inhead = tag == 'head'
+            return
+        if self.inhead:
+            attrib = dict(attrs)
+            if tag == 'meta' and 'name' in attrib:
+                self.meta.setdefault(attrib['name'].lower(), []).append(
+                    attrib.get('content') or "")
+            return
+
+        empty = empty or tag in VOIDTAGS
+        if tag in self.known:
+            self.closeimplied(tag)
+            attrib = dict((k, k if v is None else v) for k, v in attrs)
+            node = etree.SubElement(self.node, tag, attrib)
+            if not empty:
+                self.open.append((tag, node))
+        elif isBlockLevel(tag) and not empty:
+            self.raw = [self.get_starttag_text()]
+            self.rawopen = [tag]
+        else:
+            self.addraw(self.get_starttag_text())
+            if not empty:
+                self.open.append((tag, None))
+
+    def handle_startendtag(self, tag, attrs):
+
+        self.handle_starttag(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+
+        if self.raw is not None:
+            self.raw.append("</%s>" % tag)
+            if tag in self.rawopen:
+                del self.rawopen[len(self.rawopen) - 1 -
+                                 self.rawopen[::-1].index(tag):]
+            if not self.rawopen:
+                html, self.raw = "".join(self.raw), None
+                self.addblock(html)
+            return
+        if tag in DOCUMENTTAGS:
+            self.inhead = False
+            return
+        if self.inhead:
+            return
+
+        tags = [x for x, _ in self.open]
+        if tag not in tags[1:]: # a stray end tag
+            if tag not in self.known:
+                self.addraw("</%s>" % tag)
+            return
+        i = len(tags) - 1 - tags[::-1].index(tag)
+        node = self.open[i][1]
+        del self.open[i:]
+        if node is None:
+            self.addraw("</%s>" % tag)
+
+    def handle_data(self, data):
+
+        if self.raw is not None:
+            self.raw.append(data)
+        elif not self.inhead:
+            self.addtext(data)
+
+    def handle_reference(self, ref, char):
+        """Handle a reference `ref` to the character `char` (if known)."""
+
+        if self.raw is not None:
+            self.raw.append(ref)
+        elif self.inhead:
+            pass
+        elif char and (char in XMLCHARS or any(x in ('pre', 'code')
+                                               for x, _ in self.open)):
+            self.addtext(char)
+        else: # kept as is, like in Markdown
+            self.addraw(ref)
+
+    def handle_entityref(self, name):
+
+        codepoint = ENTITIES.get(name)
+        self.handle_reference("&%s;" % name, codepoint and unichr(codepoint))
+
+    def handle_charref(self, name):
+
+        try:
+            if name[:1] in "xX":
+                char = unichr(int(name[1:], 16))
+            else:
+                char = unichr(int(name))
+        except (ValueError, OverflowError):
+            char = None
+        self.handle_reference("&#%s;" % name, char)
+
+    def handle_comment(self, data):
+
+        if self.raw is not None:
+            self.raw.append("<!--%s-->" % data)
+        elif not self.inhead:
+            self.addblock("<!--%s-->" % data)
+
+    def close(self):
+
+        HTMLParser.close(self)
+        if self.raw is not None: # an unterminated raw HTML block
+            html, self.raw = "".join(self.raw), None
+            self.addblock(html)
+
+def parsehtml(html, md, known):
+    """
+    Parse an HTML string `html` to an XHTML element tree.
+
+    HTML may be a fragment (e.g. a Markdown processor's output) or a complete
+    document, whose ``<meta>`` elements are taken as meta-data. Elements not
+    in `known` are replaced by placeholders for raw HTML, stashed in the PyMD
+    instance `md`, just like ``[TOC]`` markers (see `adopt()`). Returns the
+    root element (containing the document's top-level blocks) and the
+    meta-data (a dictionary like PyMD's `Meta`).
+
+    Well-formed XHTML without comments and references to characters other
+    than XML's special characters (which is what Markdown processors usually
+    render) is parsed by a much faster XML parser, other HTML by a (lenient)
+    `TreeBuilder`.
+
+    >>> import markdown
+    >>> md = markdown.Markdown()
+    >>> root, meta = parsehtml('<p>A <a href="/x?a=1&amp;b=2">link</a>, '
+    ...                        '&copy; 2012</p>\\n<hr>', md, ['p', 'a', 'hr'])
+    >>> etree.tostring(root)
+    '<div><p>A <a href="/x?a=1&amp;b=2">link</a>, \\x02wzxhzdk:0\\x03 2012</p><hr /></div>'
+    >>> md.htmlStash.rawHtmlBlocks
+    [('&copy;', False)]
+
+XHTML documents may use the XHTML namespace:
+
+    >>> root, meta = parsehtml('<html xmlns="http://www.w3.org/1999/xhtml">'
+    ...                        '<head><meta name="labels" content="Featured"/>'
+    ...                        '</head><body><p>x</p></body></html>', md, ['p'])
+    >>> etree.tostring(root), meta
+    ('<body><p>x</p></body>', {'labels': ['Featured']})
+
+    """
+    if "\r" in html:
+        html = html.replace("\r\n", "\n").replace("\r", "\n")
+
+    match = RXXMLDECL.match(html)
+    if match:
+        html = html[match.end():]
+    if not RXNOTXML.search(html):
+        try:
+            root = etree.fromstring((u"<div>%s</div>" % html).encode('UTF8'))
+        except SyntaxError: # not well-formed
+            root = None
+        if root is not None:
+            unqualify(root)
+            meta = {}
+            if (len(root) == 1 and root[0].tag == 'html' and
+                isblank(root.text) and isblank(root[0].tail)):
+                head, body = root[0].find('head'), root[0].find('body')
+                for node in [] if head is None else head.findall('meta'):
+                    if 'name' in node.attrib:
+                        meta.setdefault(node.get('name').lower(), []).append(
+                            node.get('content') or "")
+                root = etree.Element('div') if body is None else body
+            adopt(root, md, known)
+            return root, meta
+
+    builder = TreeBuilder(md, known)
+    builder.feed(html)
+    builder.close()
+    dropblanks(builder.root)
+    tocs(builder.root, md)
+    return builder.root, builder.meta
@@ -0,0 +1,299 @@
+"""
+Incremental conversion of documents which are edited and converted again.
+
+Editor previews convert a document again and again, with only small changes
+in between. An `IncrementalConverter` splits a document into its top-level
+blocks (see `markowik.stream.segments()`), converts each block on its own,
+and caches the wiki text fragments. When converting the next version of the
+document, only blocks which changed are converted again, i.e. the time for a
+small edit hardly depends on the size of the document.
+
+The wiki text of a block also depends on
+
+- the preceding wiki text (the last `markowik.mdx.FRONTSIZE` characters, see
+  `TagFormatter.block()`), which is part of a fragment's cache key,
+- link references and abbreviations, which may be defined in any other block:
+  when a definition changes, fragments of blocks mentioning the reference id
+  or abbreviation get dropped from the cache,
+- and meta-data, which is taken from the first block (and cached with it).
+
+Like for streaming conversions, the wiki text is the same as when converting
+a document at once, except when a link reference or abbreviation is defined
+more than once. Extensions which need to see the whole document (e.g.
+*footnotes*, *toc*, or *headerid*) are not supported.
+
+"""
+import re
+
+from collections import namedtuple
+
+from markowik import stream
+from markowik.main import Converter
+from markowik.mdx import locate, trailing
+
+# =============================================================================
+
+# like `markdown.inlinepatterns.ReferencePattern.NEWLINE_CLEANUP_RE`
+RXNEWLINECLEANUP = re.compile(r'[ ]?\n')
+
+ABBRPREFIX = 'abbr-' # key prefix of abbreviation patterns (*abbr* extension)
+
+def iterlines(src, start=0):
+    r"""
+    Iterate over the lines of `src` (with newline characters), starting at
+    position `start`.
+
+    >>> list(iterlines("foo\n\nbar\nbaz", 5))
+    ['bar\n', 'baz']
+
+    """
+    end = src.find("\n", start)
+    while end >= 0:
+        yield src[start:end + 1]
+        start, end = end + 1, src.find("\n", end + 1)
+    if start < len(src):
+        yield src[start:]
+
+def mentions(text, key):
+    """
+    Check if the Markdown `text` (of a block) may use a link reference or an
+    abbreviation given by its `key`, which is a reference id or a pair of
+    ``'pattern'`` and an inline pattern key.
+
+    >>> mentions("See [the\\nDocs][].", "the docs"), mentions("See [1]", "1")
+    (True, True)
+    >>> mentions("Section 1", "1")
+    False
+    >>> key = 'pattern', 'abbr-HTML'
+    >>> mentions("Some HTML", key), mentions("Some html", key)
+    (True, False)
+
+    """
+    if not isinstance(key, tuple): # a reference id, used in brackets
+        return "[%s]" % key in RXNEWLINECLEANUP.sub(" ", text.lower())
+    key = key[1]
+    if key.startswith(ABBRPREFIX):
+        return key[len(ABBRPREFIX):] in text
+    return True # some other pattern, may be used anywhere
+
+# =============================================================================
+
+class Fragment(namedtuple('Fragment', 'wiki context preevents events '
+                                       'pragmas')):
+    """
+    The converted wiki text of a top-level block (including the tail of the
+    preceding block's wiki text), the wiki context for the next block (see
+    `trailing()`), the block's diagnostic events (see `locate()`) recorded
+    when preprocessing and when converting its element tree, and its page
+    pragmas (first blocks only).
+
+    """
+    __slots__ = ()
+
+class IncrementalConverter(object):
+    """
+    Converter which reconverts only changed blocks of a document.
+
+    Keyword arguments are the same as for `Converter` (except `jobs`). Raises
+    a `ValueError` if extensions given in `mx` need to see the whole
+    document.
+
+    Only the fragments of the document converted last are kept. The number of
+    cache hits and misses of the last conversion are given by `hits` and
+    `misses`. Unlike `Converter`, incremental converters are not thread-safe.
+
+    """
+    def __init__(self, **kwds):
+        self.converter = Converter(**kwds)
+        stream.checkextensions(self.converter)
+        self.blocks = [] # of the document converted last
+        self.fragments = {} # by block source, preceding context, and position
+        self.blockdefs = {} # definitions by block source and position
+        self.signatures = {} # of definitions of the document converted last
+        self.source, self.events = "", [] # see `diagnostics()`
+        self.hits = self.misses = 0
+
+    def split(self, src):
+        """
+        Split Markdown source `src` into top-level blocks.
+
+        Only the part of `src` which differs from the document converted last
+        is split again, blocks before and after it are taken over. That's
+        safe as the state of `markowik.stream.segments()` is the same at each
+        block boundary.
+
+        """
+        old = self.blocks
+
+        # leading blocks found unchanged in `src` (the boundary after the last
+        # one depends on the changed line following it)
+        i = start = 0
+        while i < len(old) and src.startswith(old[i], start):
+            start += len(old[i])
+            i += 1
+        if i:
+            i -= 1
+            start -= len(old[i])
+        blocks = old[:i]
+
+        # trailing blocks found unchanged in `src`, by their start positions
+        tails = {}
+        j, end = len(old), len(src)
+        while j > i and src.endswith(old[j - 1], start, end):
+            j -= 1
+            end -= len(old[j])
+            tails[end] = j
+
+        pos = start
+        for _, block in stream.segments(iterlines(src, start), size=1):
+            blocks.append(block)
+            pos += len(block)
+            if pos in tails: # a boundary, followed by unchanged blocks
+                blocks.extend(old[tails[pos]:])
+                break
+        return blocks
+
+    def definitions(self, blocks):
+        """
+        Get the link references and abbreviations of all `blocks`.
+
+        Returns definitions as given by `Converter.definitions()`. Blocks are
+        preprocessed only if they changed and may contain definitions.
+
+        """
+        converter = self.converter
+        md = converter.md
+        meta = md.preprocessors['meta'] if 'meta' in md.preprocessors else None
+
+        blockdefs = {}
+        references, patterns, keys = {}, [], {}
+        try:
+            for i, block in enumerate(blocks):
+                key = block, i == 0
+                if key in blockdefs:
+                    defs = blockdefs[key]
+                elif key in self.blockdefs:
+                    defs = blockdefs[key] = self.blockdefs[key]
+                elif "]:" in block or "*[" in block:
+                    if meta:
+                        md.preprocessors['meta'] = stream.Skip() if i else meta
+                    converter.preprocess(block)
+                    defs = blockdefs[key] = converter.definitions()
+                else:
+                    defs = blockdefs[key] = None
+                if not defs:
+                    continue
+                references.update(defs[0])
+                for k, pattern in defs[1]: # like PyMD's ordered dictionaries
+                    if k in keys:
+                        patterns[keys[k]] = k, pattern
+                    else:
+                        keys[k] = len(patterns)
+                        patterns.append((k, pattern))
+        finally:
+            if meta:
+                md.preprocessors['meta'] = meta
+
+        self.blockdefs = blockdefs
+        return references, patterns
+
+    def invalidate(self, defs):
+        """
+        Drop cached fragments which may depend on definitions which differ in
+        `defs` from those of the document converted last.
+
+        """
+        references, patterns = defs
+        signatures = dict(references)
+        for i, (k, pattern) in enumerate(patterns):
+            signatures[('pattern', k)] = i, getattr(pattern, 'title', None)
+        previous = self.signatures
+        self.signatures = signatures
+
+        changed = [k for k in set(signatures) | set(previous)
+                   if signatures.get(k) != previous.get(k)]
+        if not changed:
+            return
+        for key in list(self.fragments):
+            if any(mentions(key[0], x) for x in changed):
+                del self.fragments[key]
+
+    def convert(self, src):
+        """
+        Convert Markdown source `src` to Google Code Wiki.
+
+        Raises a `BadURL` exception just like `markowik.convert()`.
+
+        """
+        converter = self.converter
+        self.source, self.events = src, []
+        self.hits = self.misses = 0
+        if not src.strip():
+            converter.reset()
+            return u""
+
+        if "\r" in src:
+            src = src.replace("\r\n", "\n").replace("\r", "\n")
+        blocks = self.split(src)
+        defs = self.definitions(blocks)
+        self.invalidate(defs)
+
+        md = converter.md
+        meta = md.preprocessors['meta'] if 'meta' in md.preprocessors else None
+
+        fragments = {}
+        pieces, preevents, events = [], [], []
+        context = ""
+        try:
+            for i, block in enumerate(blocks):
+                key = block, context, i == 0
+                fragment = fragments.get(key) or self.fragments.get(key)
+                if fragment:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    if meta:
+                        md.preprocessors['meta'] = stream.Skip() if i else meta
+                    fragment = self.convertblock(block, context, defs)
+                fragments[key] = fragment
+                pieces.append(fragment.wiki)
+                context = fragment.context
+                preevents.extend(fragment.preevents)
+                events.extend(fragment.events)
+        finally:
+            if meta:
+                md.preprocessors['meta'] = meta
+
+        self.blocks, self.fragments = blocks, fragments
+        self.events = preevents + events # in the order of `convert()`
+        pragmas = fragments[blocks[0], "", True].pragmas
+        return "".join(converter._iterconvert(["".join(pieces)], pragmas))
+
+    def convertblock(self, block, front, defs):
+        """
+        Convert a top-level `block` preceded by wiki context `front` with
+        definitions `defs`.
+
+        Returns a `Fragment`.
+
+        """
+        converter = self.converter
+        tp = converter.tp
+        root = converter.treeprocess(converter.parseblocks(block, defs))
+        wikis = tp.iterconvert(root, front) # preprocesses the tree right away
+        preevents = list(tp.events)
+        pieces = []
+        for wiki in wikis:
+            front = trailing(front, wiki)
+            if wiki:
+                pieces.append(converter.postprocess(wiki))
+        return Fragment("".join(pieces), front, preevents,
+                        tp.events[len(preevents):], converter.pragmas())
+
+    def diagnostics(self):
+        """
+        Get diagnostics for the document converted last, like
+        `Converter.diagnostics()`.
+
+        """
+        return locate(self.source, self.events)
@@ -0,0 +1,128 @@
+"""
+Instrumentation of conversions.
+
+An instrument passed to `convert()` or a `Converter` receives timings of
+conversion phases and counts of interesting events. Phases are:
+
+``parse``
+    PyMD parsing of the Markdown source, up to the element tree
+``preprocessor``
+    Markowik's PyMD preprocessor (not included in ``parse``)
+``preprocess``
+    Markowik's preprocessing of the element tree (URL checks and such)
+``convert``
+    conversion of the element tree to wiki text
+``postprocess``
+    PyMD serialization and postprocessing of the wiki text
+``parallel``
+    tree processing, preprocessing, conversion, and postprocessing when
+    converting top-level blocks in parallel (see `markowik.parallel`), which
+    replaces the other phases except the first part of ``parse`` (worker
+    processes report ``postprocess`` too, i.e. it is included twice)
+
+Phases may be reported more than once per document, e.g. ``convert`` and
+``postprocess`` are reported for each top-level block. Counters are:
+
+``tag:NAME``
+    number of elements with tag NAME (after preprocessing)
+``url checks``
+    number of link and image URLs checked
+``bad urls``
+    number of bad URLs found
+``escaped markup``
+    number of escaped GCW markup characters (or sequences like ``{{{``)
+``escaped wikiwords``
+    number of escaped WikiWords
+``escape cache hits``, ``escape cache misses``
+    number of text fragments found respectively not found in the escape cache
+    (short fragments are not cached and thus not counted)
+``tree cache hits``, ``tree cache misses``
+    number of documents found respectively not found in the tree cache (see
+    `markowik.treecache`)
+
+Additionally, instruments are notified about diagnostics (see
+`markowik.errors.Diagnostic`) as they occur, e.g. when an element gets
+converted using some fallback. These diagnostics do not have a line number.
+
+Without an instrument, conversions do not spend any time on instrumentation.
+
+"""
+import sys
+import threading
+
+# =============================================================================
+
+class Instrument(object):
+    """
+    Base class for instruments (does nothing).
+
+    """
+    def timing(self, phase, seconds):
+        """Called when a conversion `phase` took `seconds`."""
+
+    def count(self, counter, n=1):
+        """Called to increment `counter` by `n`."""
+
+    def event(self, diagnostic):
+        """Called when a `diagnostic` occurs."""
+
+class Logger(Instrument):
+    """
+    Instrument which writes diagnostic messages to a file (default: stderr).
+
+    >>> import sys
+    >>> from markowik.errors import Diagnostic
+    >>> logger = Logger(sys.stdout)
+    >>> logger.event(Diagnostic(None, 'html link', 'http://foo.bar'))
+    info: using an HTML link for 'http://foo.bar' (it contains images or brackets)
+
+    """
+    def __init__(self, fp=None):
+        self.fp = fp
+
+    def event(self, diagnostic):
+        fp = self.fp or sys.stderr
+        fp.write("info: %s\n" % diagnostic.message)
+
+class Stats(Instrument):
+    """
+    Instrument which accumulates timings and counters (thread-safe).
+
+    >>> stats = Stats()
+    >>> stats.timing('parse', 0.25)
+    >>> stats.timing('parse', 0.5)
+    >>> stats.count('tag:p')
+    >>> stats.count('tag:p', 2)
+    >>> stats.timings, stats.counters
+    ({'parse': 0.75}, {'tag:p': 3})
+    >>> print stats
+    parse                               750.000 ms
+    tag:p                                     3
+
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def timing(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def reset(self):
+        """Reset all timings and counters."""
+
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def __str__(self):
+
+        lines = ["%-30s %12.3f ms" % (k, v * 1000)
+                 for k, v in sorted(self.timings.items())]
+        lines += ["%-30s %12d" % x for x in sorted(self.counters.items())]
+        return "\n".join(lines)
@@ -1,20 +1,554 @@
-"""Markowik command line and programmatic interface."""
+"""
+Markowik command line and programmatic interface.
 
-import argparse
+PyMD and the Markowik extension get imported only when creating a converter,
+i.e. importing this module (e.g. to show the command line help) is cheap.
+
+"""
 import codecs
+import heapq
 import re
 import sys
-
-import markdown
+import threading
+import time
 
 from markowik import util
-from markowik.mdx import MarkowikExtension, BadURL, STRIPTAG
+from markowik.errors import BadURL, UnknownTag, summarize
 
 # =============================================================================
 # programmatic interface
 # =============================================================================
 
-def convert(src, imagebaseurl="", htmlimages=False, encoding="UTF8", mx=None):
+RXBLANKLINE = re.compile(r'\n\s+\n')
+RXPLACEHOLDER = re.compile(u'\u0002wzxhzdk:(\\d+)\u0003') # for stashed HTML
+
+FRONTENDS = ('markdown', 'html') # input formats, see `Converter.parse()`
+
+
+class Context(object):
+    """
+    Per-thread conversion state of a `Converter`.
+
+    This is a PyMD instance with the Markowik extension (and its processors)
+    and the state of the document converted last by the thread.
+
+    """
+    def __init__(self, converter, mx, **kwds):
+
+        import markdown
+        from markowik.mdx import MarkowikExtension
+
+        self.mdx = MarkowikExtension(instrument=converter.instrument, **kwds)
+        self.md = markdown.Markdown(extensions=list(mx or []) + [self.mdx])
+        self.pp = self.md.preprocessors['markowik']
+        self.tp = self.md.treeprocessors['markowik']
+        self.rawhtml = None # PyMD's raw HTML post-processor, if untouched
+        for pp in self.md.postprocessors.values():
+            if pp.__class__ is markdown.postprocessors.RawHtmlPostprocessor:
+                self.rawhtml = pp
+        self.source = "" # the document converted last
+
+        # some extensions (e.g. *abbr*) register document specific inline
+        # patterns which must not leak into subsequent conversions
+        self.inlinepatterns = set(self.md.inlinePatterns.keys())
+
+def _contextattribute(name, doc):
+    """Get a property for the attribute `name` of a converter's context."""
+
+    return property(lambda self: getattr(self.context, name), doc=doc)
+
+class Converter(object):
+    """
+    Reusable Markdown to Google Code Wiki converter.
+
+    A converter is configured once and may then convert any number of
+    documents, which saves setting up a new PyMD instance for each document.
+    Keyword arguments are the same as for `convert()`.
+
+    Converters are thread-safe: all state of a conversion lives in a
+    `Context`, and each thread using a converter gets a context of its own
+    (set up when the thread converts its first document). Instruments shared
+    by threads must be thread-safe too (like those in `markowik.instrument`).
+    Within a thread, the wiki text of a document must have been consumed
+    completely (see `iterconvert()`) before converting the next document.
+
+    """
+    def __init__(self, imagebaseurl="", htmlimages=False, encoding="UTF8",
+                 mx=None, instrument=None, tags=None, wikiwords=True,
+                 escapecache=1000, jobs=1, treecache=None,
+                 frontend='markdown'):
+
+        if frontend not in FRONTENDS:
+            raise ValueError("unknown frontend '%s'" % frontend)
+        self.frontend = frontend
+        self.jobs = jobs
+        self.instrument = instrument
+        self.treecache = treecache
+        self.options = {'imagebaseurl': imagebaseurl, 'htmlimages': htmlimages,
+                        'encoding': encoding, 'mx': mx, 'tags': tags,
+                        'wikiwords': wikiwords, 'escapecache': escapecache}
+        self.local = threading.local()
+        self.context # set up now, e.g. to fail early on unknown extensions
+
+    @property
+    def context(self):
+        """The conversion context of the current thread."""
+
+        context = getattr(self.local, 'context', None)
+        if context is None:
+            context = self.local.context = Context(self, **self.options)
+        return context
+
+    md = _contextattribute('md', "The current thread's PyMD instance.")
+    mdx = _contextattribute('mdx', "The current thread's Markowik extension.")
+    pp = _contextattribute('pp', "The current thread's Markowik "
+                           "preprocessor.")
+    tp = _contextattribute('tp', "The current thread's Markowik tree "
+                           "processor.")
+    source = _contextattribute('source', "The document converted last by "
+                               "the current thread.")
+
+    @property
+    def escaper(self):
+        """The current thread's escaper (kept across documents)."""
+
+        return self.context.tp.escape
+
+    def reset(self):
+        """Reset document specific state of the underlying PyMD instance."""
+
+        context = self.context
+        md = context.md
+        md.reset()
+        md.Meta = {} # set by the *meta* extension or frontends
+        context.tp.reset()
+        context.source = ""
+        for key in list(md.inlinePatterns.keys()):
+            if key not in context.inlinepatterns:
+                del md.inlinePatterns[key]
+
+    def parse(self, src):
+        """
+        Parse Markdown source `src` to an XHTML element tree.
+
+        This runs PyMD's conversion process up to (but excluding) Markowik's
+        tree processor and returns the tree's root element. If the converter
+        has a tree cache (see `markowik.treecache`), documents parsed before
+        (by any converter using the same extensions) are taken from there.
+
+        With the ``html`` frontend, `src` is parsed as HTML instead (see
+        `parsehtml()`).
+
+        """
+        if self.frontend == 'html':
+            return self.parsehtml(src)
+
+        cache = self.treecache
+        if cache is None:
+            return self.treeprocess(self.parseblocks(src))
+
+        from markowik import treecache
+
+        instrument = self.instrument
+        if instrument:
+            t0 = time.time()
+
+        key = treecache.key(src, self.options['mx'])
+        parsed = cache.get(key)
+        if parsed is None:
+            if instrument:
+                instrument.count('tree cache misses')
+            root = self.treeprocess(self.parseblocks(src))
+            cache[key] = treecache.freeze(root, self.md)
+            return root
+
+        self.reset()
+        context = self.context
+        context.source = src
+        root = treecache.thaw(parsed, context.md)
+
+        if instrument:
+            instrument.count('tree cache hits')
+            instrument.timing('parse', time.time() - t0)
+
+        return root
+
+    def parsehtml(self, html):
+        """
+        Parse an HTML string `html` to an XHTML element tree.
+
+        HTML may be the output of another Markdown processor, which replaces
+        PyMD's parser (see `markowik.frontend`). Meta-data is taken from
+        ``<meta>`` elements, if any. Returns the tree's root element.
+
+        """
+        from markowik import frontend
+        from markowik.mdx import TagFormatter
+
+        instrument = self.instrument
+        if instrument:
+            t0 = time.time()
+
+        self.reset()
+        context = self.context
+        context.source = html
+        known = frontend.knowntags(TagFormatter(context.mdx))
+        root, context.md.Meta = frontend.parsehtml(unicode(html), context.md,
+                                                   known)
+
+        if instrument:
+            instrument.timing('parse', time.time() - t0)
+
+        return root
+
+    def preprocess(self, src, definitions=None):
+        """
+        Run PyMD's preprocessors on Markdown source `src`.
+
+        This resets any document specific state and is the first part of
+        `parseblocks()`. Link references and abbreviations defined outside of
+        `src` may be given in `definitions` (see `definitions()`). Returns the
+        preprocessed lines.
+
+        """
+        from markdown.util import STX, ETX
+
+        instrument = self.instrument
+        if instrument:
+            t0, tpp = time.time(), 0.0
+
+        self.reset()
+        context = self.context
+        context.source = src
+        md = context.md
+
+        if definitions:
+            references, patterns = definitions
+            md.references.update(references)
+            for key, pattern in patterns:
+                md.inlinePatterns[key] = pattern
+
+        # source normalization as done by `markdown.Markdown.convert()`
+        src = unicode(src).replace(STX, "").replace(ETX, "")
+        src = src.replace("\r\n", "\n").replace("\r", "\n") + "\n\n"
+        src = RXBLANKLINE.sub('\n\n', src)
+        src = src.expandtabs(md.tab_length)
+
+        md.lines = src.split("\n")
+        for prep in md.preprocessors.values():
+            if instrument and prep is context.pp:
+                t1 = time.time()
+                md.lines = prep.run(md.lines)
+                tpp = time.time() - t1
+            else:
+                md.lines = prep.run(md.lines)
+
+        if instrument:
+            instrument.timing('preprocessor', tpp)
+            instrument.timing('parse', time.time() - t0 - tpp)
+
+        return md.lines
+
+    def definitions(self):
+        """
+        Get link references and abbreviations of the document preprocessed
+        last.
+
+        Returns a pair of a dictionary of link references and a list of
+        abbreviation pattern items, which may be passed to `preprocess()`
+        when converting other documents (e.g. other parts of a document, see
+        `markowik.stream`).
+
+        """
+        context = self.context
+        patterns = [(k, v) for k, v in context.md.inlinePatterns.items()
+                    if k not in context.inlinepatterns]
+        return dict(context.md.references), patterns
+
+    def parseblocks(self, src, definitions=None):
+        """
+        Parse Markdown source `src` to a tree of block-level elements.
+
+        This is the first part of `parse()`, up to (but excluding) PyMD's tree
+        processors (which, among others, process inline markup). The optional
+        `definitions` are passed to `preprocess()`.
+
+        """
+        lines = self.preprocess(src, definitions)
+
+        if self.instrument:
+            t0 = time.time()
+
+        root = self.md.parser.parseDocument(lines).getroot()
+
+        if self.instrument:
+            self.instrument.timing('parse', time.time() - t0)
+
+        return root
+
+    def treeprocess(self, root):
+        """
+        Run PyMD's tree processors (except Markowik's) on the tree `root`.
+
+        This is the second part of `parse()`. Returns the processed tree.
+
+        """
+        if self.instrument:
+            t0 = time.time()
+
+        context = self.context
+        for tp in context.md.treeprocessors.values():
+            if tp is not context.tp:
+                root = tp.run(root) or root
+
+        if self.instrument:
+            self.instrument.timing('parse', time.time() - t0)
+
+        return root
+
+    def validate(self, src):
+        """
+        Find problems which would occur when converting Markdown source `src`.
+
+        Instead of raising an exception for the first bad URL or unknown tag,
+        this finds them all, together with elements which can be converted
+        only using some fallback (e.g. HTML links). Documents are only parsed
+        and preprocessed, not converted, which is much faster than `convert()`.
+
+        Returns a list of `markowik.errors.Diagnostic` objects.
+
+        """
+        from markowik.mdx import locate
+
+        if not src.strip():
+            return []
+        events = self.tp.validate(self.parse(src))
+        return [x for x in locate(src, events) if x.kind not in x.NOTES]
+
+    def diagnostics(self):
+        """
+        Get diagnostics for the document converted last.
+
+        These are notes about elements which have been converted using some
+        fallback (see `validate()`) or in some special way. When using
+        `iterconvert()`, diagnostics are complete only after all pieces of
+        wiki text have been consumed.
+
+        Returns a list of `markowik.errors.Diagnostic` objects.
+
+        """
+        from markowik.mdx import locate
+
+        context = self.context
+        return locate(context.source, context.tp.events)
+
+    def checkurls(self, src):
+        """
+        Check all link and image URLs in Markdown source `src`.
+
+        Where `convert()` raises a `BadURL` exception for the first bad URL,
+        this returns all bad URLs at once, as a list of URL and source line
+        number pairs (see `validate()`).
+
+        """
+        return [(x.subject, x.line) for x in self.validate(src)
+                if x.kind == 'bad url']
+
+    def pragmas(self):
+        """Get wiki page pragmas for the document parsed last."""
+
+        meta = getattr(self.md, 'Meta', {})
+        meta = dict((k.lower(), " ".join(v)) for k, v in meta.items())
+        if any(x in meta for x in ('summary', 'labels')):
+            summary = meta.get('summary', '')
+            labels = meta.get('labels', '')
+            return "#summary %s\n#labels %s\n\n" % (summary, labels)
+        return ""
+
+    def postprocess(self, wiki):
+        """
+        Post-process a piece of wiki text.
+
+        This runs PyMD's serialization and post-processors on `wiki` (e.g. to
+        restore raw HTML) and un-escapes XML characters afterwards.
+
+        """
+        from markowik.mdx import etree, STRIPTAG
+
+        if self.instrument:
+            t0 = time.time()
+
+        elem = etree.Element(STRIPTAG)
+        elem.text = wiki
+        context = self.context
+        wiki = context.md.serializer(elem)[len(STRIPTAG) + 2:-len(STRIPTAG) - 3]
+        for pp in context.md.postprocessors.values():
+            if pp is context.rawhtml:
+                wiki = self.restorehtml(wiki)
+            else:
+                wiki = pp.run(wiki)
+
+        # un-escape XML characters
+        for x, y in [("&lt;", "<"), ("&gt;", ">"), ("&amp;", "&")]:
+            wiki = wiki.replace(x, y)
+
+        if self.instrument:
+            self.instrument.timing('postprocess', time.time() - t0)
+
+        return wiki
+
+    def restorehtml(self, wiki):
+        """
+        Restore stashed raw HTML in a piece of wiki text.
+
+        This yields the same as PyMD's raw HTML post-processor, which checks
+        each stashed HTML fragment, i.e. post-processing each piece of a
+        document would take quadratic time. Instead, only the fragments whose
+        placeholders occur in `wiki` (respectively in restored fragments) are
+        checked, in the same order.
+
+        """
+        md, pp = self.md, self.context.rawhtml
+        stash = md.htmlStash
+        todo = [int(x) for x in RXPLACEHOLDER.findall(wiki)]
+        todo = [x for x in set(todo) if x < stash.html_counter]
+        seen = set(todo)
+        heapq.heapify(todo)
+        while todo:
+            i = heapq.heappop(todo)
+            html, safe = stash.rawHtmlBlocks[i]
+            if md.safeMode and not safe:
+                if str(md.safeMode).lower() == 'escape':
+                    html = pp.escape(html)
+                elif str(md.safeMode).lower() == 'remove':
+                    html = ''
+                else:
+                    html = md.html_replacement_text
+            placeholder = stash.get_placeholder(i)
+            if pp.isblocklevel(html) and (safe or not md.safeMode):
+                wiki = wiki.replace("<p>%s</p>" % placeholder, html + "\n")
+            wiki = wiki.replace(placeholder, html)
+            for j in RXPLACEHOLDER.findall(html):
+                j = int(j)
+                if i < j < stash.html_counter and j not in seen:
+                    seen.add(j)
+                    heapq.heappush(todo, j)
+        return wiki
+
+    def iterconvert(self, src):
+        """
+        Convert Markdown source `src` to Google Code Wiki piece by piece.
+
+        Returns an iterator over the wiki text, yielding one piece per
+        top-level block. This keeps only one block's wiki text in memory at a
+        time (next to the parsed source).
+
+        Raises a `BadURL` exception just like `convert()`, but already when
+        calling this method, i.e. before any wiki text has been yielded.
+
+        """
+        if not src.strip():
+            self.reset()
+            return iter([])
+        if (self.jobs > 1 and self.treecache is None and
+            self.frontend == 'markdown'):
+            from markowik import parallel
+            root = self.parseblocks(src)
+            pieces = parallel.convert(self, root)
+            if pieces is not None:
+                return self._iterconvert(pieces)
+            root = self.treeprocess(root)
+        else:
+            root = self.parse(src)
+        pieces = self.tp.iterconvert(root)
+        return self._iterconvert(self.postprocess(x) for x in pieces if x)
+
+    def iterconverttree(self, root, meta=None):
+        """
+        Convert an XHTML element tree to Google Code Wiki piece by piece.
+
+        Like `iterconvert()`, but for a document which has been parsed
+        already, e.g. by another Markdown processor (see `markowik.frontend`).
+        The tree is given by `root`, an element whose children are the
+        document's top-level blocks (like the ``<div>`` root of PyMD's trees,
+        or an HTML ``<body>``), or an element tree. Tags may be in the XHTML
+        namespace. Meta-data may be given in `meta`, a dictionary like PyMD's
+        `Meta` (or with string values). The tree gets modified.
+
+        """
+        from markowik import frontend
+        from markowik.mdx import TagFormatter
+
+        if hasattr(root, 'getroot'):
+            root = root.getroot()
+        frontend.unqualify(root)
+        if root.tag == 'html' and root.find('body') is not None:
+            root = root.find('body')
+
+        self.reset()
+        context = self.context
+        context.md.Meta = dict((k.lower(), [v] if isinstance(v, basestring)
+                                else list(v)) for k, v in (meta or {}).items())
+        known = frontend.knowntags(TagFormatter(context.mdx))
+        frontend.adopt(root, context.md, known)
+        pieces = context.tp.iterconvert(root)
+        return self._iterconvert(self.postprocess(x) for x in pieces if x)
+
+    def _iterconvert(self, pieces, pragmas=None):
+        """
+        Yield page pragmas (default: those of the document parsed last) and
+        post-processed wiki text `pieces`.
+
+        """
+        if pragmas is None:
+            pragmas = self.pragmas()
+        if pragmas:
+            yield unicode(pragmas)
+
+        # strip leading and trailing newlines of the whole wiki text
+        head, newlines = True, ""
+        for wiki in pieces:
+            if head:
+                wiki = wiki.lstrip("\n")
+            body = wiki.rstrip("\n")
+            if body:
+                yield unicode(newlines + body)
+                head, newlines = False, ""
+            newlines += wiki[len(body):]
+
+    def convertto(self, src, fp):
+        """
+        Convert Markdown source `src` and write the wiki text to `fp`.
+
+        The wiki text is written piece by piece (see `iterconvert()`) to the
+        file-like object `fp`.
+
+        """
+        for wiki in self.iterconvert(src):
+            fp.write(wiki)
+
+    def convert(self, src):
+        """
+        Convert Markdown source `src` to Google Code Wiki.
+
+        Raises a `BadURL` exception just like `convert()`.
+
+        """
+        return "".join(self.iterconvert(src))
+
+    def converttree(self, root, meta=None):
+        """
+        Convert an XHTML element tree to Google Code Wiki.
+
+        Arguments are the same as for `iterconverttree()`. Raises a `BadURL`
+        exception just like `convert()`.
+
+        """
+        return "".join(self.iterconverttree(root, meta))
+
+def convert(src, imagebaseurl="", htmlimages=False, encoding="UTF8", mx=None,
+            instrument=None, tags=None, wikiwords=True, escapecache=1000,
+            jobs=1, treecache=None, frontend='markdown'):
     """
     Convert Markdown to Google Code Wiki.
 
@@ -24,34 +558,92 @@ def convert(src, imagebaseurl="", htmlimages=False, encoding="UTF8", mx=None):
     Raises a `BadURL` exception when links or images (including `imagebaseurl`)
     have URLs not supported (respectively recognized) by GCW.
 
+    An `instrument` receives timings of conversion phases and counts of
+    processed elements, escapes, and URL checks (see `markowik.instrument`).
+
+    Elements are converted by handlers registered per tag. Elements without a
+    handler (e.g. introduced by extensions given in `mx`) raise an
+    `UnknownTag` exception. Additional handlers can be given in `tags`, a
+    dictionary mapping tags to functions which get called with a
+    `markowik.mdx.TagFormatter`, the wiki context preceding the element, its
+    already converted content, and its attributes. They must return the
+    element's wiki text.
+
+    WikiWords are escaped, unless `wikiwords` is false. It may also be a
+    collection of page names which should not be escaped (i.e. linked by
+    GCW). Escaped text fragments are cached, `escapecache` sets the cache
+    size (0 disables caching). Cache statistics are available through
+    `Converter.escaper.cache`.
+
+    Set `jobs` to convert top-level blocks of a document by multiple
+    processes (see `markowik.parallel`), which speeds up conversion of large
+    documents. The result is the same as for conversions by a single process.
+
+    A `treecache` (see `markowik.treecache`) keeps parsed documents, so that
+    converting a document again with other options (e.g. another
+    `imagebaseurl`) skips parsing. Documents are then parsed and converted
+    by a single process, regardless of `jobs`.
+
+    Set `frontend` to ``'html'`` to convert HTML instead of Markdown, e.g.
+    XHTML already rendered by another Markdown processor (see
+    `markowik.frontend`). Parsing HTML is much faster than parsing Markdown
+    with PyMD, which is skipped then (as are `jobs` and the `treecache`).
+    Use `Converter.converttree()` to convert an XHTML element tree.
+
+    Use a `Converter` when converting many documents with the same options,
+    or `convertmany()` to convert them by multiple threads.
+
     """
-    # convert
-    mx = mx or []
-    mx.append(MarkowikExtension(imagebaseurl, htmlimages, encoding))
-    md = markdown.Markdown(extensions=mx)
-    wiki = md.convert(src)
-    xpatt = r'^<%s>\n*|\n*</%s>$' % (STRIPTAG, STRIPTAG)
-    wiki = re.sub(xpatt, '', wiki)
-
-    # add pragmas
-    meta = getattr(md, 'Meta', {})
-    meta = dict((k.lower(), " ".join(v)) for k, v in meta.items())
-    if any(x in meta for x in ('summary', 'labels')):
-        summary = meta.get('summary', '')
-        labels = meta.get('labels', '')
-        wiki = "#summary %s\n#labels %s\n\n%s" % (summary, labels, wiki)
-
-    # un-escape XML characters
-    for x, y in [("&lt;", "<"), ("&gt;", ">"), ("&amp;", "&")]:
-        wiki = wiki.replace(x, y)
-
-    return wiki
+    converter = Converter(imagebaseurl, htmlimages, encoding, mx,
+                          instrument=instrument, tags=tags,
+                          wikiwords=wikiwords, escapecache=escapecache,
+                          jobs=jobs, treecache=treecache, frontend=frontend)
+    return converter.convert(src)
+
+def validate(src, imagebaseurl="", htmlimages=False, mx=None, tags=None,
+             frontend='markdown'):
+    """
+    Find problems which would occur when converting Markdown to Google Code
+    Wiki.
+
+    Keyword arguments are the same as for `convert()`. Returns a list of
+    `markowik.errors.Diagnostic` objects (see `Converter.validate()`).
+
+    """
+    converter = Converter(imagebaseurl, htmlimages, mx=mx, tags=tags,
+                          frontend=frontend)
+    return converter.validate(src)
+
+def convertmany(docs, workers=4, **kwds):
+    """
+    Convert multiple Markdown documents using a pool of `workers` threads.
+
+    All threads share one `Converter`, configured by keyword arguments (see
+    `convert()`). Returns a list of the documents' wiki text, in the order
+    of `docs`. If a conversion fails, its exception is raised.
+
+    Threads do not speed up conversions themselves (which are CPU-bound),
+    this is rather useful in applications which already serve requests by
+    threads. Use `markowik.batch` to convert many files by multiple processes.
+
+    """
+    from multiprocessing.pool import ThreadPool
+
+    converter = Converter(**kwds)
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(converter.convert, docs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
 # =============================================================================
 # command line interface
 # =============================================================================
 
-def options():
+def options(args=None):
+
+    import argparse
 
     desc = """
         Convert Markdown to Google Code Wiki.
@@ -64,9 +656,15 @@ def options():
 
     p = argparse.ArgumentParser(description=desc, epilog=epilog)
     p.add_argument('input', metavar='INFILE',
-                   help="markdown file")
+                   help="markdown file, directory, or glob pattern")
     p.add_argument('output', metavar='OUTFILE', nargs='?', default=None,
-                   help="wiki file (default: stdout)")
+                   help="wiki file (default: stdout), respectively output "
+                   "directory if INFILE is a directory or a glob pattern")
+    p.add_argument('--from', metavar='FORMAT', dest='frontend',
+                   choices=FRONTENDS, default='markdown',
+                   help="input format, one of %s (default: %%(default)s), "
+                   "e.g. html to convert the output of another markdown "
+                   "processor" % ", ".join(FRONTENDS))
     p.add_argument('--mx', metavar='MX', nargs='*',
                    help="markdown extensions to activate")
     p.add_argument('--image-baseurl', metavar='URL', dest='imagebaseurl',
@@ -75,41 +673,211 @@ def options():
     p.add_argument('--html-images', default=False, action='store_true',
                    dest='htmlimages',
                    help="always use HTML for images")
+    p.add_argument('--link-wikiwords', metavar='PAGE', nargs='*',
+                   dest='wikiwords', default=None,
+                   help="do not escape WikiWords, i.e. let GCW link them "
+                   "(only those matching a given PAGE name, if any)")
     p.add_argument('--encoding', default='UTF8',
                    help="encoding of input and output (default: %(default)s)")
     p.add_argument('--quiet', default=True, action='store_false',
                    dest='verbose',
                    help="disable info messages")
+    p.add_argument('--jobs', metavar='N', type=int, default=None,
+                   help="number of parallel conversions when converting "
+                   "multiple files (default: number of CPUs), respectively "
+                   "number of processes converting the blocks of a single "
+                   "file (default: 1)")
+    p.add_argument('--stream', metavar='KB', type=int, nargs='?', const=1024,
+                   default=None,
+                   help="convert a single file segment by segment, with "
+                   "segments of at least KB kilobytes (default: %(const)s), "
+                   "to limit memory usage for very large files")
+    p.add_argument('--tree-cache', metavar='DIR', dest='treecache',
+                   default=None,
+                   help="cache parsed documents in DIR, to skip parsing when "
+                   "converting the same files again with other options (e.g. "
+                   "another image base URL)")
+    p.add_argument('--check', default=False, action='store_true',
+                   help="do not convert but report all problems a conversion "
+                   "would run into (with file names and line numbers)")
+    p.add_argument('--check-urls', default=False, action='store_true',
+                   dest='checkurls',
+                   help="like --check, but only report bad link and image "
+                   "URLs")
+    p.add_argument('--force', default=False, action='store_true',
+                   help="when converting multiple files, also convert files "
+                   "which did not change since their last conversion")
+
+    return p.parse_args(args)
 
-    return p.parse_args()
+def converteroptions(opts):
+    """Get `Converter` keyword arguments from command line options `opts`."""
+
+    kwds = ('imagebaseurl', 'htmlimages', 'encoding', 'mx')
+    kwds = dict((k, getattr(opts, k)) for k in kwds)
+    if opts.wikiwords is not None: # otherwise use default (escape all)
+        kwds['wikiwords'] = opts.wikiwords or False
+    if opts.frontend != 'markdown': # keep working with older versions
+        kwds['frontend'] = opts.frontend
+    if opts.treecache:
+        from markowik.treecache import TreeCache
+        kwds['treecache'] = TreeCache(opts.treecache)
+    return kwds
 
 def abort(msg):
 
     print("abort: %s" % msg)
     sys.exit(1)
 
+def runbatch(opts, kwds, log):
+    """Convert multiple files (command line batch mode)."""
+
+    from markowik import batch
+
+    if not opts.output:
+        abort("an output directory is required when converting multiple files")
+    if opts.jobs is not None and opts.jobs < 1:
+        abort("number of jobs must be positive")
+
+    def report(fname, diagnostics):
+        if diagnostics:
+            log("%s: %s" % (fname, summarize(diagnostics)))
+
+    failed = 0
+    results = batch.convert(opts.input, opts.output, opts.jobs, opts.force,
+                            report if opts.verbose else None, log, **kwds)
+    for fname, error in results:
+        if error:
+            failed += 1
+            sys.stderr.write("error: %s: %s\n" % (
+                fname, error.encode(opts.encoding)))
+
+    if failed:
+        abort("failed to convert %d file(s)" % failed)
+
+def runcheck(opts, kwds):
+    """Validate one or multiple files (command line check mode)."""
+
+    from markowik import batch
+
+    if batch.isbatch(opts.input):
+        results = batch.validate(opts.input, opts.jobs, **kwds)
+    else:
+        try:
+            with codecs.open(opts.input, 'r', opts.encoding) as fp:
+                md = fp.read()
+        except IOError as e:
+            abort("failed to open input file (%s)" % e)
+        results = [(opts.input, Converter(**kwds).validate(md), None)]
+
+    urlsonly = opts.checkurls and not opts.check
+    nproblems = nfiles = failed = 0
+    for fname, diagnostics, error in sorted(results):
+        if error:
+            failed += 1
+            sys.stderr.write("error: %s: %s\n" % (
+                fname, error.encode(opts.encoding)))
+        if urlsonly:
+            diagnostics = [x for x in diagnostics if x.kind == 'bad url']
+        for diagnostic in diagnostics:
+            sys.stdout.write("%s:%s: %s\n" % (
+                fname, diagnostic.line or "?",
+                diagnostic.message.encode(opts.encoding)))
+        nproblems += len(diagnostics)
+        nfiles += bool(diagnostics)
+
+    if failed:
+        abort("failed to check %d file(s)" % failed)
+    if nproblems:
+        abort("found %d %s in %d file(s)" % (nproblems, "bad URL(s)" if
+                                             urlsonly else "problem(s)",
+                                             nfiles))
+
+def writeout(opts, pieces):
+    """Write wiki text `pieces` to the output file (or stdout)."""
+
+    try:
+        if opts.output:
+            try:
+                util.writefile(opts.output, pieces, opts.encoding)
+            except (IOError, OSError) as e:
+                abort("failed to write output file (%s)" % e)
+        else:
+            for wiki in pieces:
+                sys.stdout.write(wiki.encode(opts.encoding))
+            sys.stdout.write("\n")
+    except (BadURL, UnknownTag) as e:
+        abort(e)
+
+def runstream(opts, kwds, log):
+    """Convert a single file segment by segment (command line stream mode)."""
+
+    from markowik import stream
+
+    if opts.stream < 1:
+        abort("segment size must be positive")
+
+    converter = Converter(**kwds)
+    diagnostics = [] if opts.verbose else None
+    try:
+        pieces = stream.iterconvert(converter, opts.input, opts.encoding,
+                                    opts.stream * 1024, diagnostics)
+    except IOError as e:
+        abort("failed to open input file (%s)" % e)
+    except (BadURL, UnknownTag, ValueError) as e: # in the first segment
+        abort(e)
+
+    writeout(opts, pieces)
+
+    for diagnostic in diagnostics or []:
+        log("%s:%s: %s" % (opts.input, diagnostic.line or "?",
+                           diagnostic.message))
+    peak = util.peakmemory()
+    if peak:
+        log("peak memory usage: %.1f MB" % (peak / 1048576.0))
+
 def main():
 
+    if sys.argv[1:2] == ['serve']:
+        from markowik import server
+        server.main(sys.argv[2:])
+        return
+
+    from markowik.batch import isbatch # batch imports this module
+
     opts = options()
-    util.VERBOSE = opts.verbose
+    log = util.logger(opts.verbose)
+    kwds = converteroptions(opts)
+
+    if opts.check or opts.checkurls:
+        runcheck(opts, kwds)
+        return
+
+    if isbatch(opts.input):
+        if opts.stream is not None:
+            abort("streaming works with single files only")
+        runbatch(opts, kwds, log)
+        return
+
+    if opts.stream is not None:
+        runstream(opts, kwds, log)
+        return
+
     try:
         with codecs.open(opts.input, 'r', opts.encoding) as fp:
             md = fp.read()
     except IOError as e:
         abort("failed to open input file (%s)" % e)
 
-    kwds = ('imagebaseurl', 'htmlimages', 'encoding', 'mx')
-    kwds = dict((k, getattr(opts, k)) for k in kwds)
+    converter = Converter(jobs=opts.jobs or 1, **kwds)
     try:
-        wiki = convert(md, **kwds)
-    except BadURL as e:
+        pieces = converter.iterconvert(md)
+    except (BadURL, UnknownTag) as e: # the latter from parallel conversions
         abort(e)
 
-    if opts.output:
-        try:
-            with codecs.open(opts.output, 'w', opts.encoding) as fp:
-                fp.write(wiki)
-        except IOError as e:
-            abort("failed to write output file (%s)" % e)
-    else:
-        print wiki.encode(opts.encoding)
+    writeout(opts, pieces)
+
+    if opts.verbose: # locating diagnostics is not for free
+        for diagnostic in converter.diagnostics():
+            log("%s:%s: %s" % (opts.input, diagnostic.line or "?",
+                               diagnostic.message))
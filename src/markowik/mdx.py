@@ -1,20 +1,20 @@
 """Markowik Markdown extension."""
 
-from itertools import izip_longest
-import os
+import itertools
 import re
 import textwrap
+import time
+import types
 
 import markdown
 from markdown.inlinepatterns import ESCAPE_RE, SimpleTextPattern
 from markdown.util import etree, STX
 
-from markowik.util import dump, log, truncate, escapewikiwords
+from markowik.errors import BadURL, UnknownTag, Diagnostic
+from markowik.util import dump, Escaper
 
 # =============================================================================
 
-DEBUG = "MARKOWIK_DEBUG" in os.environ
-
 SPANLEVELTAGS = """
 em strong code
 span sub sup
@@ -35,30 +35,161 @@ RXABSURLX = re.compile(r'^(?:https?|ftp)://')
 # Valid GCW page names:
 RXPAGENAME = re.compile(r'^\w+$')
 
-# (mis)using control characters:
-DDX = u'\u0004' # dedent marker for a line
-TRX = u'\u0005' # temporary replacement marker
+# Valid link URLs (a combination of the above):
+RXLINKURL = re.compile(r'^(?:(?:https?|ftp)://|\w+$)')
+
+RXWHITESPACE = re.compile(r'\s+')
+
+# Link and image locations in Markdown source (approximately):
+RXLOCATION = re.compile(r'(?:[(<=]|\]:)[ \t]*["\']?([^\s()<>"\']+)')
 
 # =============================================================================
 
-class BadURL(Exception):
+FRONTSIZE = 2 # number of trailing characters relevant for `TagFormatter.block`
+
+INDENT = "  " # indentation per list or blockquote level
+
+def trailing(front, text, indent=""):
+    r"""
+    Get the wiki context for text following `front` and `text`.
+
+    Text written at a nested level (see `TagFormatter.indent`) may end with
+    a line break and its `indent`, which is not part of the context.
+
+    >>> trailing("", "foo")
+    'oo'
+    >>> trailing("* ", "")
+    '* '
+    >>> trailing("\n ", "x")
+    ' x'
+    >>> trailing("", "foo\n    ", "    ")
+    'o\n'
+
+    """
+    n = len(indent)
+    if n and text.endswith(indent) and text[-n - 1:-n] == "\n":
+        text = text[-FRONTSIZE - n:-n]
+    return (front + text[-FRONTSIZE:])[-FRONTSIZE:]
+
+def iternodes(root):
+    """
+    Iterate over the elements of the tree `root` in document order.
+
+    Unlike `root.getiterator()`, which is recursive, this works for trees
+    nested deeper than Python's recursion limit.
+
+    >>> root = etree.fromstring("<div><p>a <em>b</em></p><hr /></div>")
+    >>> [node.tag for node in iternodes(root)]
+    ['div', 'p', 'em', 'hr']
+
     """
-    Indicates an invalid or missing protocol in a URL.
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node))
+
+def lstripnewlines(text, newline="\n"):
+    r"""
+    Strip leading `newline` strings (line breaks followed by indentation).
+
+    >>> lstripnewlines("\n  \n  foo\n  ", "\n  ")
+    'foo\n  '
+
+    """
+    n = len(newline)
+    start = 0
+    while text.startswith(newline, start):
+        start += n
+    return text[start:]
+
+def rstripnewlines(text, newline="\n"):
+    r"""
+    Strip trailing `newline` strings (line breaks followed by indentation).
+
+    >>> rstripnewlines("\n  foo\n  \n  ", "\n  ")
+    '\n  foo'
 
     """
-    def __init__(self, url):
-        msg = ("the URL '%s' has an invalid or missing protocol prefix (must "
-               "be one of http, https, or ftp)" % url)
-        super(BadURL, self).__init__(msg)
+    n = len(newline)
+    end = len(text)
+    while end >= n and text.endswith(newline, 0, end):
+        end -= n
+    return text[:end]
+
+def stripout(out, start, lstrip, rstrip):
+    """
+    Strip the text given by the strings `out[start:]` in place.
+
+    Strings are stripped by the `lstrip` and `rstrip` functions, from either
+    end until one is not empty afterwards.
+
+    """
+    for i in xrange(start, len(out)):
+        out[i] = lstrip(out[i])
+        if out[i]:
+            break
+    for i in xrange(len(out) - 1, start - 1, -1):
+        out[i] = rstrip(out[i])
+        if out[i]:
+            break
+
+def lastchars(out, start, n):
+    """Get (at most) the last `n` characters of the text `out[start:]`."""
+
+    chars, length = [], 0
+    for i in xrange(len(out) - 1, start - 1, -1):
+        chars.append(out[i])
+        length += len(out[i])
+        if length >= n:
+            break
+    chars.reverse()
+    return "".join(chars)[-n:]
 
 # =============================================================================
 
 class TagFormatter(object):
+    """
+    Converts elements to wiki syntax, one handler per tag.
+
+    Handlers are looked up in the `handlers` dictionary, which maps tags to
+    functions taking the wiki context preceding the element (see `block()`),
+    its already converted content, and its attributes. Additional handlers
+    may be given in the extension's `tags` dictionary: these are called with
+    the formatter as an additional first argument (like methods).
+
+    Content of list items and blockquotes is indented as it is written, i.e.
+    each line break is followed by the indentation of the current nesting
+    level (see `indent` and `newline`), and nested content is never indented
+    again. Handlers which break lines must use `newline`.
+
+    Elements which contain other block-level elements (lists, list items,
+    blockquotes, and idle elements) are formatted by *writers* instead of
+    handlers (unless given in the extension's `tags`). Writers get the
+    element's content as the strings `out[start:]` of the wiki text written
+    so far and format it in place, i.e. nested content is not copied at each
+    nesting level. The first of these strings is reserved for the element's
+    prefix, see `writeli()` for an example.
 
+    """
     def __init__(self, mdx):
         self.mdx = mdx
         self.liststack = []
         self.blockquotestack = []
+        self.indent = "" # of the content of the current element
+
+        self.handlers = dict((x, getattr(self, x)) for x in self.formattags)
+        for tag in self.idletags:
+            self.handlers[tag] = self.idle
+        for tag in self.htmlspanleveltags:
+            self.handlers[tag] = self.htmlspanlevel(tag)
+        self.writers = dict((x, getattr(self, "write%s" % x))
+                            for x in self.writetags)
+        for tag in self.idletags:
+            self.writers[tag] = self.writeidle
+        for tag, handler in (mdx.tags or {}).items():
+            self.handlers[tag] = types.MethodType(handler, self)
+            self.writers.pop(tag, None)
 
     # -------------------------------------------------------------------------
     # state handling utilities
@@ -69,12 +200,22 @@ class TagFormatter(object):
             self.liststack.append(tag)
         elif tag == 'blockquote':
             self.blockquotestack.append(tag)
+        if tag in ('li', 'blockquote'):
+            self.indent += INDENT
 
     def onleave(self, tag):
         if tag in ('ul', 'ol'):
             self.liststack.pop()
         elif tag == 'blockquote':
             self.blockquotestack.pop()
+        if tag in ('li', 'blockquote'):
+            self.indent = self.indent[len(INDENT):]
+
+    @property
+    def newline(self):
+        """A line break within the content of the current element."""
+
+        return "\n%s" % self.indent
 
     # -------------------------------------------------------------------------
     # helpers
@@ -100,40 +241,77 @@ class TagFormatter(object):
         elem += [">%s</%s>" % (text, tag)] if text else [" />"]
         return "".join(elem)
 
+    def strip(self, text, indent):
+        """
+        Strip leading and trailing line breaks (each followed by `indent`)
+        from `text`.
+
+        """
+        newline = "\n%s" % indent
+        return rstripnewlines(lstripnewlines(text, newline), newline)
+
+    def written(self, writer, front, text, attrib):
+        """Format `text` using `writer`, like a handler."""
+
+        out = ["", text]
+        writer(front, out, 0, attrib)
+        return "".join(out)
+
     def block(self, front, text, islist=False, isblockquote=False):
         """
         Format a converted block element (i.e. `text` is already in wiki
-        syntax) in context of its preceding wiki code (given by `front`).
+        syntax) in context of its preceding wiki code (given by `front`, which
+        needs to contain at least the last `FRONTSIZE` characters).
 
         """
-        text = text.strip("\n")
+        out = ["", text]
+        self.writeblock(front, out, 0, islist, isblockquote)
+        return "".join(out)
+
+    def writeblock(self, front, out, start, islist=False, isblockquote=False):
+        """Format a block element in place (like `block()`)."""
+
+        # a blockquote's own line breaks are outside of its content
+        indent = self.indent[len(INDENT):] if isblockquote else self.indent
+        newline = "\n%s" % indent
+        stripout(out, start, lambda x: lstripnewlines(x, newline),
+                 lambda x: rstripnewlines(x, newline))
         nestedblock = ((len(self.liststack) - islist) or
                        len(self.blockquotestack) - isblockquote)
         if nestedblock:
             noheadlb = any(front.endswith(x) for x in ("\n", "* ", "# "))
-            head = "" if noheadlb else "\n"
-            tail = "\n"
+            out[start] = "" if noheadlb else newline
+            out.append(newline)
         else:
-            head = ""
-            tail = "\n\n"
-        return "%s%s%s" % (head, text, tail)
+            out[start] = ""
+            out.append("\n\n")
 
     # -------------------------------------------------------------------------
     # tag content formatter
     # -------------------------------------------------------------------------
 
+    formattags = """
+    strong em code p pre h1 h2 h3 h4 h5 h6 ul ol li br hr blockquote a img
+    dl dt dd span table tr th td
+    """.split()
+
+    writetags = ('ul', 'ol', 'li', 'blockquote')
+
     idletags = ('div', 'thead', 'tbody')
 
     htmlspanleveltags = ('sub', 'sup')
 
-    def __getattr__(self, name):
+    def idle(self, _front, text, _attrib):
+        return text
 
-        if name in self.idletags:
-            return lambda _, text, *x: text
-        if name in self.htmlspanleveltags:
-            return lambda _, text, *x: '<%s>%s</%s>' % (name, text, name)
+    def writeidle(self, _front, _out, _start, _attrib):
+        pass
 
-        raise AttributeError(name)
+    def htmlspanlevel(self, tag):
+        """Get a handler which keeps `tag` as plain HTML."""
+
+        head, tail = "<%s>" % tag, "</%s>" % tag
+        return lambda _front, text, _attrib: "%s%s%s" % (head, text, tail)
 
     def strong(self, _front, text, _attrib):
         return "*%s*" % text
@@ -148,51 +326,64 @@ class TagFormatter(object):
         return self.block(front, text)
 
     def pre(self, front, text, _attrib):
-        text = ("\n%s" % DDX).join(text.split("\n"))
-        return self.block(front, "{{{\n%s%s\n}}}" % (DDX, text))
+        # code lines are not indented
+        return self.block(front, "{{{\n%s%s}}}" % (text, self.newline))
 
     def h1(self, _front, text, _attrib):
-        return "= %s =\n\n" % text
+        return "= %s =%s%s" % (text, self.newline, self.newline)
 
     def h2(self, _front, text, _attrib):
-        return "== %s ==\n\n" % text
+        return "== %s ==%s%s" % (text, self.newline, self.newline)
 
     def h3(self, _front, text, _attrib):
-        return "=== %s ===\n\n" % text
+        return "=== %s ===%s%s" % (text, self.newline, self.newline)
 
     def h4(self, _front, text, _attrib):
-        return "==== %s ====\n\n" % text
+        return "==== %s ====%s%s" % (text, self.newline, self.newline)
 
     def h5(self, _front, text, _attrib):
-        return "===== %s =====\n\n" % text
+        return "===== %s =====%s%s" % (text, self.newline, self.newline)
 
     def h6(self, _front, text, _attrib):
-        return "====== %s ======\n\n" % text
+        return "====== %s ======%s%s" % (text, self.newline, self.newline)
+
+    def ul(self, front, text, attrib):
+        return self.written(self.writeul, front, text, attrib)
 
-    def ul(self, front, text, _attrib):
-        return self.block(front, text, islist=True)
+    def writeul(self, front, out, start, _attrib):
+        self.writeblock(front, out, start, islist=True)
 
     def ol(self, front, text, attrib):
         return self.ul(front, text, attrib)
 
-    def li(self, _front, text, _attrib):
+    def writeol(self, front, out, start, attrib):
+        self.writeul(front, out, start, attrib)
+
+    def li(self, front, text, attrib):
+        return self.written(self.writeli, front, text, attrib)
+
+    def writeli(self, _front, out, start, _attrib):
         c = "#" if self.liststack[-1] == 'ol' else "*"
-        text = "\n  ".join(text.split("\n"))
-        return "  %s %s\n" % (c, text.strip())
+        stripout(out, start, lambda x: x.lstrip(), lambda x: x.rstrip())
+        out[start] = "  %s " % c
+        out.append("\n%s" % self.indent[len(INDENT):])
 
     def br(self, _front, _text, _attrib):
-        return "<br/>\n"
+        return "<br/>%s" % self.newline
 
     def hr(self, front, _text, _attrib):
         return self.block(front, "-" * 10)
 
-    def blockquote(self, front, text, _attrib):
-        text = "\n  ".join(text.split("\n"))
-        return self.block(front, "  %s\n" % (text.strip()), isblockquote=True)
+    def blockquote(self, front, text, attrib):
+        return self.written(self.writeblockquote, front, text, attrib)
+
+    def writeblockquote(self, front, out, start, _attrib):
+        stripout(out, start, lambda x: x.lstrip(), lambda x: x.rstrip())
+        self.writeblock(front, out, start, isblockquote=True)
+        out[start] += INDENT
 
     def a(self, _front, text, attrib):
         if attrib['html']:
-            log("using an HTML link for '%s'" % text)
             return self.element('a', text, attrib)
         return "[%s %s]" % (attrib['href'], text)
 
@@ -202,14 +393,14 @@ class TagFormatter(object):
         return attrib['src']
 
     def dl(self, front, text, _attrib):
-        text = "<dl>\n%s</dl>" % text
+        text = "<dl>%s%s</dl>" % (self.newline, text)
         return self.block(front, text)
 
     def dt(self, _front, text, _attrib):
-        return "<dt>%s</dt>\n" % text.strip("\n")
+        return "<dt>%s</dt>%s" % (self.strip(text, self.indent), self.newline)
 
     def dd(self, _front, text, _attrib):
-        return "<dd>%s</dd>\n" % text.strip("\n")
+        return "<dd>%s</dd>%s" % (self.strip(text, self.indent), self.newline)
 
     def span(self, _front, text, attrib):
         return self.element('span', text, attrib)
@@ -218,7 +409,7 @@ class TagFormatter(object):
         return self.block(front, text)
 
     def tr(self, _front, text, _attrib):
-        return "%s||\n" % text
+        return "%s||%s" % (text, self.newline)
 
     def th(self, _front, text, _attrib):
         return "|| *%s* " % text
@@ -245,23 +436,44 @@ class MarkowikTreeprocessor(markdown.treeprocessors.Treeprocessor):
     def __init__(self, mdx):
         markdown.treeprocessors.Treeprocessor.__init__(self)
         self.mdx = mdx
+        self.instrument = mdx.instrument
+        self.escape = Escaper(mdx.wikiwords, mdx.escapecache, mdx.instrument)
+        self.reset()
 
-    def run(self, root):
-        """
-        Walk and edit the tree given by `root`.
+    def reset(self):
+        """Reset document specific state."""
 
-        """
+        # checked URLs, mapping image locations to the results of
+        # `checkimage()`, respectively link URLs to a verdict
+        self.imageurls = {}
+        self.linkurls = {}
 
-        dump(root, "XHTML")
+        # diagnostics of the current document, each given by a kind and a
+        # subject (see `markowik.errors.Diagnostic`) as well as some source
+        # text to locate it in the document (see `locate()`)
+        self.events = []
 
-        self.preprocess(root, None)
+        # if set, bad URLs are recorded as diagnostics instead of raising
+        # `BadURL` (see `validate()`)
+        self.collect = False
 
-        dump(root, "Preprocessed")
+    def event(self, kind, subject, text):
+        """
+        Record a diagnostic (see `reset()`).
 
-        wiki = self.convert("", root, TagFormatter(self.mdx))
+        Messages are not formatted here, only instruments may do so.
 
-        # dedent according to DDX markers:
-        wiki = re.sub(r'\n *%s' % DDX, '\n', wiki)
+        """
+        self.events.append((kind, subject, text))
+        if self.instrument:
+            self.instrument.event(Diagnostic(None, kind, subject))
+
+    def run(self, root):
+        """
+        Walk and edit the tree given by `root`.
+
+        """
+        wiki = "".join(self.iterconvert(root))
 
         elem = etree.Element(STRIPTAG)
         elem.text = wiki
@@ -274,10 +486,68 @@ class MarkowikTreeprocessor(markdown.treeprocessors.Treeprocessor):
 
         return root
 
+    def iterconvert(self, root, front=""):
+        """
+        Preprocess the tree given by `root` and convert it piece by piece.
+
+        Returns an iterator over the wiki text of top-level elements. The tree
+        is preprocessed (and thus checked for bad URLs) before this method
+        returns. The wiki text preceding the tree's content may be given in
+        `front` (see `trailing()`).
+
+        """
+        dump(root, "XHTML")
+
+        instrument = self.instrument
+        if instrument:
+            t0 = time.time()
+            try:
+                self.preprocess(root, None)
+            except BadURL:
+                instrument.count('bad urls')
+                raise
+            instrument.timing('preprocess', time.time() - t0)
+            self.countnodes(root)
+        else:
+            self.preprocess(root, None)
+
+        dump(root, "Preprocessed")
+
+        # the root is an idle element, i.e. its content is its wiki text
+        return self.convertcontent(front, root, TagFormatter(self.mdx))
+
     def preprocess(self, node, nextnode):
         """
         Preprocess the XHTML tree generated by `markdown.convert()`.
 
+        The tree is walked iteratively, i.e. deeply nested elements do not hit
+        Python's recursion limit.
+
+        """
+        # stack of elements to preprocess and their next sibling
+        stack = [(node, nextnode)]
+        while stack:
+            node, nextnode = stack.pop()
+            self.preprocessnode(node, nextnode)
+            last = len(node) - 1
+            for i in xrange(last, -1, -1):
+                stack.append((node[i], node[i + 1] if i < last else None))
+
+    def countnodes(self, root):
+        """Count elements per tag and URL checks in the tree `root`."""
+
+        counts = {}
+        for node in iternodes(root):
+            counts[node.tag] = counts.get(node.tag, 0) + 1
+        for tag, n in counts.items():
+            self.instrument.count('tag:%s' % tag, n)
+        self.instrument.count('url checks',
+                              counts.get('a', 0) + counts.get('img', 0))
+
+    def preprocessnode(self, node, nextnode):
+        """
+        Preprocess a single element `node` (`nextnode` is its next sibling).
+
         """
         # --- inject linebreaks between subsequent nested paragraphs ----------
 
@@ -286,14 +556,15 @@ class MarkowikTreeprocessor(markdown.treeprocessors.Treeprocessor):
             index = 0
             minindex = 1 if node.tag == 'li' else 0
             lb = etree.Element('br')
-            for child in list(node):
+            while index < len(node):
+                child = node[index]
                 # For whatever reason, the first linebreak in a list item
                 # introduces a new paragraph in GCW while subsequent linebreaks
                 # are handled as whitespace, i.e. in these cases an explicit
                 # <br/> is needed.
                 if index > minindex and prev.tag == 'p' and child.tag == 'p':
-                    log("using <br/> to fake nested paragraph '%s'" %
-                        truncate(child.text or "...", 15))
+                    self.event('nested paragraph', child.text,
+                               child.text or "")
                     node.insert(index, lb)
                     index += 1
                 index += 1
@@ -302,7 +573,7 @@ class MarkowikTreeprocessor(markdown.treeprocessors.Treeprocessor):
         # --- replace <abbr> by <span> ----------------------------------------
 
         if node.tag == 'abbr':
-            log("replacing <abbr> by <span> ('%s')" % truncate(node.text, 15))
+            self.event('abbr', node.text, node.text or "")
             node.tag = 'span'
 
         # --- collapse <pre><code> to <pre> -----------------------------------
@@ -324,103 +595,252 @@ class MarkowikTreeprocessor(markdown.treeprocessors.Treeprocessor):
             not (nextnode and nextnode.tag in SPANLEVELTAGS)):
             node.tail = node.tail.strip("\n")
         if node.tag != 'pre':
-            node.text = re.sub(r'\s+', ' ', node.text or "")
+            node.text = RXWHITESPACE.sub(' ', node.text)
         else:
             node.text = textwrap.dedent(node.text)
             assert not node
-        node.tail = re.sub(r'\s+', ' ', node.tail or "")
+        node.tail = RXWHITESPACE.sub(' ', node.tail)
 
         # --- prefix image urls -----------------------------------------------
 
         if node.tag == 'img':
-            isrc = node.attrib['src']
-            if not RXABSURL.search(isrc):
-                isrc = "%s%s" % (self.mdx.imagebaseurl, isrc)
-            if not RXABSURLX.search(isrc):
-                raise BadURL(isrc)
-            if not RXIMGEXT.search(isrc):
-                conn = "&" if "?" in isrc else "?"
-                isrc = "%s%sx=x.png" % (isrc, conn)
-                log("appending artificial image file extension (%s)" % isrc)
+            src = node.attrib['src']
+            try:
+                isrc, ok, suffixed = self.imageurls[src]
+            except KeyError:
+                isrc, ok, suffixed = self.imageurls[src] = self.checkimage(src)
+            if not ok:
+                self.badurl(isrc, src)
+            elif suffixed:
+                self.event('image extension', isrc, src)
             node.attrib['src'] = isrc
 
         # --- check link URLs -------------------------------------------------
 
         if node.tag == 'a':
             url = node.attrib['href']
-            if RXABSURL.search(url):
-                if not RXABSURLX.search(url):
-                    raise BadURL(url)
-            elif not RXPAGENAME.search(url):
-                raise BadURL(url)
+            ok = self.linkurls.get(url)
+            if ok is None:
+                ok = self.linkurls[url] = bool(RXLINKURL.search(url))
+            if not ok:
+                self.badurl(url, url)
+
+    def checkimage(self, src):
+        """
+        Check and rewrite an image location `src`.
+
+        Returns the URL to use in wiki text, whether it is supported by GCW,
+        and whether it got an artificial image file extension.
+
+        """
+        isrc = src
+        if not RXABSURL.search(isrc):
+            isrc = "%s%s" % (self.mdx.imagebaseurl, isrc)
+        if not RXABSURLX.search(isrc):
+            return isrc, False, False
+        if not RXIMGEXT.search(isrc):
+            conn = "&" if "?" in isrc else "?"
+            isrc = "%s%sx=x.png" % (isrc, conn)
+            return isrc, True, True
+        return isrc, True, False
+
+    def badurl(self, url, src):
+        """
+        Handle a bad `url` (`src` is the URL as given in the document).
+
+        Raises `BadURL` unless bad URLs get collected (see `validate()`).
+
+        """
+        if not self.collect:
+            raise BadURL(url)
+        self.event('bad url', url, src)
+
+    def validate(self, root):
+        """
+        Preprocess the tree given by `root` and find conversion problems.
+
+        Instead of raising a `BadURL` exception for the first bad URL, all bad
+        URLs are collected, just like unknown tags and elements which need some
+        fallback to be converted. The tree is not converted.
 
-        # --- traverse child nodes --------------------------------------------
+        Returns the recorded diagnostics (see `reset()`).
 
-        for child, nextnode in izip_longest(node, node[1:]):
-            self.preprocess(child, nextnode)
+        """
+        self.collect = True
+        try:
+            self.preprocess(root, None)
+        finally:
+            self.collect = False
+
+        handlers = TagFormatter(self.mdx).handlers
+        for node in iternodes(root):
+            if node is root: # converted as an idle element
+                continue
+            if node.tag not in handlers:
+                self.event('unknown tag', node.tag, "<%s" % node.tag)
+            elif node.tag == 'a' and self.ishtmllink(node):
+                url = node.attrib['href']
+                self.event('html link', url, url)
+
+        return self.events
 
     def convert(self, front, node, formatter):
         """
         Convert the elements tree `node` to wiki syntax.
 
-        The preceding wiki context is given in `front`, the wiki text converted
-        so far.
+        The preceding wiki context is given in `front`, the trailing characters
+        of the wiki text converted so far (see `trailing()`).
+
+        The tree is walked iteratively, i.e. deeply nested elements do not hit
+        Python's recursion limit.
 
         """
-        def escaped(node, x):
-            """Escape GCW reserved characters and WikiWords."""
-
-            if node.tag in ('pre', 'code'):
-                return x
-            if node.tag != 'a':
-                x = escapewikiwords(x)
-            if node.tag == 'a' and not node.attrib['html']:
-                return x
-            x = re.sub(r'`', TRX, x)
-            x = re.sub(r'({{{|}}})', r'`\1`', x)
-            x = re.sub(TRX, '{{{`}}}', x)
-            x = re.sub(r'([[\]_*])', r'`\1`', x)
-            return x
-
-        # --- links need special handling -------------------------------------
+        # wiki text written so far, as a list of strings, and a stack of
+        # elements in conversion, each given as a list of the element, its
+        # front, the index of its content in `out` (preceded by a string
+        # reserved for its prefix, see `TagFormatter`), the wiki context for
+        # the next chunk of content, and the index of the next child to convert
+        self.convertlink(node)
+        text = self.escaped(node, node.text)
+        out = ["", text]
+        stack = [[node, front, 0, trailing(front, text), 0]]
+        handlers, writers = formatter.handlers, formatter.writers
+
+        while True:
+
+            top = stack[-1]
+            node, front, start, context, index = top
+
+            # --- descend to next child ---------------------------------------
+
+            if index < len(node):
+                top[4] += 1
+                child = node[index]
+                formatter.onenter(child.tag)
+                self.convertlink(child)
+                text = self.escaped(child, child.text)
+                stack.append([child, context, len(out),
+                              trailing(context, text), 0])
+                out.append("")
+                out.append(text)
+                continue
 
-        if node.tag == 'a':
-            plainimagelink = (len(node) == 1 and node[0].tag == 'img'
-                              and not node.text and not node[0].tail)
-            if plainimagelink and not self.mdx.htmlimages:
-                isrc = node[0].attrib['src']
-                href = node.attrib['href']
-                node.clear()
-                node.attrib['href'] = href
-                node.text = isrc
-                node.tail = ""
-                html = False
+            # --- all children converted, now convert the element -------------
+
+            stack.pop()
+            writer = writers.get(node.tag)
+            if writer:
+                writer(front, out, start, node.attrib)
             else:
-                text = node.text or ""
-                html = bool(node) or "]" in text or STX in text
-            node.attrib['html'] = html
+                try:
+                    handler = handlers[node.tag]
+                except KeyError:
+                    raise UnknownTag(node.tag)
+                text = "".join(out[start:])
+                del out[start + 1:]
+                out[start] = handler(front, text, node.attrib)
+            if not stack:
+                return "".join(out)
+            formatter.onleave(node.tag)
+            indent = formatter.indent
+            wiki = lastchars(out, start, FRONTSIZE + len(indent) + 1)
+            parent = stack[-1]
+            tail = self.escaped(parent[0], node.tail)
+            out.append(tail)
+            parent[3] = trailing(trailing(parent[3], wiki, indent), tail)
+
+    def convertlink(self, node):
+        """
+        Prepare a link element `node` for conversion.
+
+        Plain image links are reduced to the image's URL (if not using HTML
+        images), other links are marked whether they need to be converted to
+        HTML links.
+
+        """
+        if node.tag != 'a':
+            return
+
+        if self.isplainimagelink(node) and not self.mdx.htmlimages:
+            isrc = node[0].attrib['src']
+            href = node.attrib['href']
+            node.clear()
+            node.attrib['href'] = href
+            node.text = isrc
+            node.tail = ""
+            html = False
+        else:
+            html = self.ishtmllink(node)
+            if html:
+                self.event('html link', node.attrib['href'],
+                           node.attrib['href'])
+        node.attrib['html'] = html
+
+    def isplainimagelink(self, node):
+        """Check if the link element `node` contains only an image."""
 
-        # --- recursively convert node contents, leaves first -----------------
+        return (len(node) == 1 and node[0].tag == 'img' and not node.text and
+                not node[0].tail)
 
-        s = escaped(node, node.text)
+    def ishtmllink(self, node):
+        """Check if the link element `node` must be converted to HTML."""
+
+        if self.isplainimagelink(node) and not self.mdx.htmlimages:
+            return False
+        text = node.text or ""
+        return bool(node) or "]" in text or STX in text
+
+    def convertcontent(self, front, node, formatter):
+        """
+        Convert the content of `node`, i.e. its text and child elements.
+
+        Yields the wiki text of the node's text, its child elements and their
+        tails, one after another. Arguments are the same as for `convert()`.
+
+        """
+        instrument = self.instrument
+        chunk = self.escaped(node, node.text)
+        yield chunk
+        context = trailing(front, chunk)
         for child in node:
             formatter.onenter(child.tag)
-            s += self.convert(front + s, child, formatter)
-            s += escaped(node, child.tail)
+            if instrument:
+                t0 = time.time()
+                wiki = self.convert(context, child, formatter)
+                instrument.timing('convert', time.time() - t0)
+            else:
+                wiki = self.convert(context, child, formatter)
             formatter.onleave(child.tag)
+            for chunk in (wiki, self.escaped(node, child.tail)):
+                yield chunk
+                context = trailing(context, chunk, formatter.indent)
 
-        return getattr(formatter, node.tag)(front, s, node.attrib)
+    def escaped(self, node, text):
+        """Escape GCW reserved characters and WikiWords in `node`'s `text`."""
+
+        if node.tag in ('pre', 'code'):
+            return text
+        if node.tag != 'a':
+            return self.escape(text)
+        if not node.attrib['html']:
+            return text
+        return self.escape(text, wikiwords=False)
 
 # =============================================================================
 
 class MarkowikExtension(markdown.Extension):
     """The markdown extension that saves your life."""
 
-    def __init__(self, imagebaseurl, htmlimages, encoding):
+    def __init__(self, imagebaseurl, htmlimages, encoding, instrument=None,
+                 tags=None, wikiwords=True, escapecache=1000):
         markdown.Extension.__init__(self)
         self.imagebaseurl = imagebaseurl
         self.htmlimages = htmlimages
         self.encoding = encoding
+        self.instrument = instrument # see `markowik.instrument`
+        self.tags = tags # additional handlers, see `TagFormatter`
+        self.wikiwords = wikiwords # see `markowik.util.Escaper`
+        self.escapecache = escapecache
 
     def extendMarkdown(self, md, md_globals):
 
@@ -432,6 +852,66 @@ class MarkowikExtension(markdown.Extension):
 
 # =============================================================================
 
+def locate(src, events):
+    r"""
+    Locate diagnostics recorded by `MarkowikTreeprocessor.event()` (given in
+    document order by `events`) in Markdown source `src`.
+
+    Returns a list of `Diagnostic` objects sorted by line numbers. Diagnostics
+    concerning URLs are reported for each line where the URL occurs as a link
+    or image location. Others, and URLs not found that way, get the line
+    number of the next occurrence of their source text (searching from the
+    previous text found), if any, else `None`. Duplicates are dropped.
+
+    >>> src = "[a](foo-bar)\n\n![b][x]\nfoo-bar [c](foo-bar)\n\n[x]: y.png"
+    >>> for d in locate(src, [('bad url', 'foo-bar', 'foo-bar'),
+    ...                       ('bad url', 'y.png', 'y.png'),
+    ...                       ('bad url', 'foo-bar', 'foo-bar'),
+    ...                       ('nested paragraph', 'foo...', 'foo-bar [c]'),
+    ...                       ('unknown tag', 'del', '<del')]):
+    ...     print d.line, d.kind, d.subject
+    1 bad url foo-bar
+    4 bad url foo-bar
+    4 nested paragraph foo...
+    6 bad url y.png
+    None unknown tag del
+
+    """
+    lines = src.splitlines()
+
+    # line numbers of link and image locations, found in one pass
+    urllines = {}
+    for i, line in enumerate(lines, 1):
+        for url in RXLOCATION.findall(line):
+            urllines.setdefault(url, []).append(i)
+
+    diagnostics = []
+    seen = set()
+    start = 0 # where to start searching text fragments
+    for event in events:
+        if event in seen:
+            continue
+        seen.add(event)
+        kind, subject, text = event
+        found = []
+        isurl = kind in ('bad url', 'html link', 'image extension')
+        if isurl:
+            found = sorted(set(urllines.get(text, ())))
+        else: # a text fragment, up to inline placeholders or line breaks
+            text = text.split(STX)[0].strip().split("\n")[0][:30]
+        if not found and text:
+            for i in itertools.chain(xrange(start, len(lines)),
+                                     xrange(start)):
+                if text in lines[i]:
+                    found = [i + 1]
+                    if not isurl:
+                        start = i
+                    break
+        diagnostics += [Diagnostic(i, kind, subject) for i in found or [None]]
+    return sorted(diagnostics, key=lambda x: (x.line is None, x.line))
+
+# =============================================================================
+
 def tocomat(md):
     r"""
     Replace a `[TOC X]` marker by a GCW TOC-tag with depths X.
@@ -0,0 +1,279 @@
+"""
+Parallel conversion of the top-level blocks of a document.
+
+Most of the conversion time of large documents is spent on PyMD's inline
+processing and Markowik's tree walks, which work on each top-level block of a
+document independently. After parsing the block structure of a document, the
+top-level blocks are split into chunks which are converted by forked worker
+processes. Workers inherit the parsed tree and the state of the converter
+(e.g. link references and stashed HTML), i.e. only chunk indexes and the
+resulting wiki text need to be passed between processes.
+
+Conversions yield the same wiki text as serial conversions. This relies on
+some knowledge about how PyMD and Markowik work:
+
+- Only PyMD's inline and prettify tree processors are run by workers (on the
+  blocks of a chunk). Other tree processors (added by extensions) may need to
+  see the whole tree, in that case documents get converted serially.
+- Markowik's preprocessing of an element considers its next sibling, so
+  chunks only end before elements which are not span-level elements and
+  after elements without tail text (where inline processing could insert new
+  elements).
+- Conversion of a top-level block depends on the trailing characters of the
+  preceding wiki text (see `markowik.mdx.trailing()`). Workers assume the
+  usual blank line for the first block of a chunk. If the actual preceding
+  text differs, the chunk is converted again in the parent process.
+
+Parallel conversion requires forked processes, i.e. on Windows documents are
+always converted serially. Parallel conversions by multiple threads are
+serialized (workers inherit the state of one conversion at a time). As the
+state is inherited, workers are forked for each document, i.e. converters do
+not keep a pool of workers (passing the state to resident workers would cost
+more than forking them).
+
+Timings, counts, and diagnostics reported to a converter's instrument by
+workers are recorded and passed on to the instrument by the parent process.
+
+"""
+import multiprocessing
+import sys
+import threading
+import time
+
+from markowik.errors import BadURL, UnknownTag
+from markowik.instrument import Instrument
+from markowik.mdx import etree, iternodes, trailing, TagFormatter
+from markowik.mdx import SPANLEVELTAGS
+
+# =============================================================================
+
+PARALLELTREEPROCESSORS = ('inline', 'prettify')
+
+CHUNKSPERJOB = 4 # chunks per worker process (to balance load)
+
+FRONT = "\n\n" # usual wiki text preceding a top-level block
+
+def weight(node):
+    """Estimate the conversion effort for the block `node`."""
+
+    return sum(len(x.text or "") + 1 for x in iternodes(node))
+
+def chunks(root, n):
+    """
+    Split the children of `root` into up to `n` chunks of similar weight.
+
+    Returns a list of start and end indexes.
+
+    """
+    weights = [weight(x) for x in root]
+    limit = sum(weights) / float(n)
+
+    bounds = []
+    start, acc = 0, 0
+    for i, w in enumerate(weights):
+        acc += w
+        end = i + 1
+        splittable = (end < len(root) and not root[i].tail and
+                      root[end].tag not in SPANLEVELTAGS)
+        if acc >= limit and splittable:
+            bounds.append((start, end))
+            start, acc = end, 0
+    if start < len(root):
+        bounds.append((start, len(root)))
+    return bounds
+
+# =============================================================================
+# workers
+# =============================================================================
+
+class Recorder(Instrument):
+    """
+    Instrument which records calls, to be replayed on another instrument.
+
+    >>> from markowik.instrument import Stats
+    >>> recorder, stats = Recorder(), Stats()
+    >>> recorder.timing('postprocess', 0.5)
+    >>> recorder.count('url checks', 2)
+    >>> replay(recorder.calls, stats)
+    >>> stats.timings, stats.counters
+    ({'postprocess': 0.5}, {'url checks': 2})
+
+    """
+    def __init__(self):
+        self.calls = []
+
+    def timing(self, phase, seconds):
+        self.calls.append(('timing', (phase, seconds)))
+
+    def count(self, counter, n=1):
+        self.calls.append(('count', (counter, n)))
+
+    def event(self, diagnostic):
+        self.calls.append(('event', (diagnostic,)))
+
+def replay(calls, instrument):
+    """Replay `calls` recorded by a `Recorder` on `instrument`."""
+
+    for name, args in calls:
+        getattr(instrument, name)(*args)
+
+_state = None # converter and parsed root, inherited by workers
+_lock = threading.Lock() # guards `_state`
+_recorder = None # records instrument calls in workers
+
+def _initworker():
+    """Let the worker's copy of the converter report to a `Recorder`."""
+
+    global _recorder
+
+    converter = _state[0]
+    if converter.instrument:
+        _recorder = Recorder()
+        tp = converter.tp
+        converter.instrument = converter.mdx.instrument = _recorder
+        tp.instrument = tp.escape.instrument = _recorder
+
+def _treeprocess(node):
+    """Run tree processors on the given block-level (or root) `node`."""
+
+    converter = _state[0]
+    for name, tp in converter.md.treeprocessors.items():
+        if name in PARALLELTREEPROCESSORS:
+            node = tp.run(node) or node
+    return node
+
+def _convertchunk(job):
+    """
+    Convert a chunk of blocks (`job` is a start and end index and the front).
+
+    Returns the post-processed wiki text pieces of the blocks, the trailing
+    characters of their wiki text, the diagnostics recorded meanwhile, and
+    the calls of the instrument (in workers, see `Recorder`). If conversion
+    fails, the error's type and its argument are returned instead.
+
+    """
+    start, end, front = job
+    converter, root = _state
+    tp = converter.tp
+    nevents = len(tp.events)
+
+    # a container to process the chunk like a tree of its own
+    chunk = etree.Element(root.tag, root.attrib)
+    for node in root[start:end]:
+        chunk.append(node)
+    chunk = _treeprocess(chunk)
+    nextnode = root[end] if end < len(root) else None
+
+    try:
+        for i, node in enumerate(chunk):
+            tp.preprocess(node, chunk[i + 1] if i + 1 < len(chunk) else
+                          nextnode)
+    except BadURL as e:
+        return 'BadURL', e.url
+    if tp.instrument:
+        for node in chunk:
+            tp.countnodes(node)
+
+    pieces = []
+    context = front
+    formatter = TagFormatter(converter.mdx)
+    try:
+        for node in chunk:
+            formatter.onenter(node.tag)
+            wiki = tp.convert(context, node, formatter)
+            formatter.onleave(node.tag)
+            for wiki in (wiki, tp.escaped(chunk, node.tail)):
+                context = trailing(context, wiki)
+                if wiki:
+                    pieces.append(converter.postprocess(wiki))
+    except UnknownTag as e:
+        return 'UnknownTag', e.tag
+
+    events = tp.events[nevents:]
+    del tp.events[nevents:] # when converting in the parent process
+    calls = []
+    if _recorder:
+        calls, _recorder.calls = _recorder.calls, []
+    return pieces, context, events, calls
+
+# =============================================================================
+
+def convert(converter, root):
+    """
+    Convert the parsed block-level tree `root` using `converter.jobs` worker
+    processes.
+
+    Returns a list of post-processed wiki text pieces, or `None` if the tree
+    should be converted serially (too small to split or not convertible in
+    parallel).
+
+    """
+    if sys.platform == 'win32':
+        return None
+    names = [k for k, v in converter.md.treeprocessors.items()
+             if v is not converter.tp]
+    if set(names) - set(PARALLELTREEPROCESSORS):
+        return None
+    bounds = chunks(root, converter.jobs * CHUNKSPERJOB)
+    if len(bounds) < 2:
+        return None
+
+    global _state
+
+    instrument = converter.instrument
+    if instrument:
+        t0 = time.time()
+
+    tp = converter.tp
+    _lock.acquire()
+    _state = converter, root
+    try:
+
+        # the root's text, processed on a copy without the blocks
+        skeleton = etree.Element(root.tag, root.attrib)
+        skeleton.text = root.text
+        skeleton.append(etree.Element(root[0].tag))
+        skeleton = _treeprocess(skeleton)
+        tp.preprocessnode(skeleton, None)
+        text = tp.escaped(skeleton, skeleton.text)
+
+        jobs = [(start, end, FRONT) for start, end in bounds]
+        jobs[0] = bounds[0] + (trailing("", text),)
+        pool = multiprocessing.Pool(min(converter.jobs, len(jobs)),
+                                    _initworker)
+        try:
+            results = pool.map(_convertchunk, jobs, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # like in serial conversions, bad URLs are reported first
+        for result in results:
+            if result[0] == 'BadURL':
+                raise BadURL(result[1])
+
+        pieces = []
+        if text:
+            pieces.append(converter.postprocess(text))
+        context = trailing("", text)
+        for job, result in zip(jobs, results):
+            if job[2] != context: # converted with wrong preceding text
+                result = _convertchunk(job[:2] + (context,))
+            if result[0] == 'UnknownTag':
+                raise UnknownTag(result[1])
+            pieces += result[0]
+            context = result[1]
+            tp.events += result[2]
+            if instrument:
+                replay(result[3], instrument)
+
+    finally:
+        _state = None
+        _lock.release()
+
+    if instrument:
+        instrument.count('tag:%s' % root.tag) # blocks are counted by workers
+        instrument.timing('parallel', time.time() - t0)
+
+    return pieces
@@ -0,0 +1,170 @@
+"""
+Conversion server which keeps converters resident between requests.
+
+Requests and responses are JSON objects, exchanged either line by line over
+stdin and stdout or as HTTP POST request and response bodies. A request
+looks like this::
+
+    {"id": 1, "src": "Some *markdown*", "options": {"mx": ["tables"]}}
+
+Options (all optional) correspond to the keyword arguments of `convert()`.
+The `id` (also optional) is passed through to the response::
+
+    {"id": 1, "wiki": "Some _markdown_"}
+
+Failed conversions yield an error response (the `url` is only set for bad
+URLs, other error types are `BadRequest` for malformed requests or the name of
+any other exception raised during conversion)::
+
+    {"id": 1, "error": {"type": "BadURL", "message": "...", "url": "..."}}
+
+"""
+import argparse
+import BaseHTTPServer
+import json
+import sys
+import threading
+
+from markowik.errors import message
+from markowik.main import Converter, BadURL
+
+# =============================================================================
+
+OPTIONS = ('imagebaseurl', 'htmlimages', 'encoding', 'mx', 'wikiwords')
+
+class BadRequest(Exception):
+    """Indicates a malformed request."""
+
+class Server(object):
+    """
+    Handles conversion requests using resident converters.
+
+    One converter is kept for each distinct set of options, up to `maxsize`
+    converters (the least recently used ones are dropped). Requests may be
+    handled by multiple threads at once.
+
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.converters = {}
+        self.lru = []
+        self.lock = threading.Lock()
+
+    def converter(self, options):
+        """Get a converter for `options`."""
+
+        if not isinstance(options, dict) or set(options) - set(OPTIONS):
+            raise BadRequest("options must be an object with keys from %s" %
+                             ", ".join(OPTIONS))
+        if not isinstance(options.get('mx') or [], list):
+            raise BadRequest("option 'mx' must be a list")
+        if not isinstance(options.get('wikiwords', True), (bool, list)):
+            raise BadRequest("option 'wikiwords' must be a boolean or a list")
+
+        key = tuple((k, tuple(v) if isinstance(v, list) else v)
+                    for k, v in sorted(options.items()))
+        with self.lock:
+            if key in self.converters:
+                self.lru.remove(key)
+            else:
+                kwds = dict((str(k), v) for k, v in options.items())
+                self.converters[key] = Converter(**kwds)
+                if len(self.lru) == self.maxsize:
+                    del self.converters[self.lru.pop(0)]
+            self.lru.append(key)
+            return self.converters[key]
+
+    def handle(self, request):
+        """Handle a request (given as a JSON string), return the response."""
+
+        response = {'id': None}
+        try:
+            try:
+                request = json.loads(request)
+            except ValueError as e:
+                raise BadRequest("invalid JSON (%s)" % e)
+            if not isinstance(request, dict):
+                raise BadRequest("request must be an object")
+            response['id'] = request.get('id')
+            src = request.get('src')
+            if not isinstance(src, basestring):
+                raise BadRequest("request must have a string 'src'")
+            converter = self.converter(request.get('options') or {})
+            response['wiki'] = converter.convert(src)
+        except BadURL as e:
+            response['error'] = {'type': 'BadURL', 'message': message(e),
+                                 'url': e.url}
+        except Exception as e: # keep serving, whatever happened
+            response['error'] = {'type': type(e).__name__,
+                                 'message': message(e)}
+        return json.dumps(response)
+
+# =============================================================================
+# transports
+# =============================================================================
+
+def servelines(server, infp, outfp):
+    """Serve JSON-lines requests from `infp`, write responses to `outfp`."""
+
+    for line in iter(infp.readline, ""):
+        if not line.strip():
+            continue
+        outfp.write("%s\n" % server.handle(line))
+        outfp.flush()
+
+class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+
+        size = int(self.headers.get('content-length') or 0)
+        response = self.server.markowik.handle(self.rfile.read(size))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+def servehttp(server, host, port):
+    """Serve HTTP POST requests on `host` and `port`."""
+
+    httpd = BaseHTTPServer.HTTPServer((host, port), HTTPRequestHandler)
+    httpd.markowik = server
+    httpd.serve_forever()
+
+# =============================================================================
+# command line interface
+# =============================================================================
+
+def main(args=None):
+
+    desc = """
+        Run a resident conversion server which reads JSON requests line by
+        line from stdin and writes responses to stdout, or alternatively
+        serves requests via HTTP.
+    """
+
+    p = argparse.ArgumentParser(prog="markowik serve", description=desc)
+    p.add_argument('--http', metavar='[HOST:]PORT', default=None,
+                   help="serve HTTP POST requests on the given port (host "
+                   "defaults to localhost)")
+    opts = p.parse_args(args)
+
+    server = Server()
+    if opts.http:
+        host, _, port = opts.http.rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            p.error("invalid port: %s" % port)
+        try:
+            servehttp(server, host or "localhost", port)
+        except KeyboardInterrupt:
+            pass
+    else:
+        servelines(server, sys.stdin, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+Memory-bounded conversion of very large documents.
+
+Converting a document keeps its source, its parsed element tree, and the
+preprocessed lines in memory at once, which does not work out for documents
+of some hundred megabytes (e.g. generated ones). Streaming conversions read a
+document file segment by segment and convert each segment (and write out its
+wiki text) before reading the next one, i.e. memory usage is bounded by the
+segment size instead of the document size.
+
+Segments are split at safe top-level block boundaries. These are lines which
+follow a blank line, which are not indented, and which do not start a list
+item, a blockquote, a definition, raw HTML, or a link reference. Lines within
+a fenced code block or a raw HTML block, and lines following a definition list
+or a link reference are no boundaries either. In other words, segments start
+with a paragraph, a header, a table, or a horizontal rule.
+
+Link references and abbreviations may be defined anywhere in a document, so
+files are read twice: first to collect all definitions (by running PyMD's
+preprocessors on each segment), then to convert the segments with all
+definitions in place. Meta-data (i.e. page pragmas) is only taken from the
+first segment.
+
+The wiki text is the same as when converting a document at once, except when
+a link reference or abbreviation is defined more than once (within the segment
+of an earlier definition, that one wins). Extensions which need to see the
+whole document (e.g. *footnotes*, *toc*, or *headerid*) are not supported.
+Segments are converted by a single process, regardless of the converter's
+`jobs` setting.
+
+"""
+import io
+import itertools
+import re
+
+from markowik.mdx import trailing
+
+# =============================================================================
+
+SEGMENTSIZE = 1 << 20 # minimum size of a segment in characters
+
+# tree processors which work on each top-level block on its own
+STREAMTREEPROCESSORS = ('inline', 'prettify', 'attr_list', 'hilite')
+
+WHITESPACE = " \t\n\r\f\v" # like `\s` in PyMD's regular expressions
+
+RXNOBOUNDARY = re.compile(r'[\s<>:]|[*+-]\s|\d+\.\s|\[[^\]]*\]:|\*\[')
+RXFENCE = re.compile(r'(~{3,}|`{3,})')
+RXDEFINITION = re.compile(r'[ ]{0,3}:[ ]')
+RXREFERENCE = re.compile(r'[ ]{0,3}\[[^\]]*\]:|\*\[') # or abbreviation
+RXHTMLTAG = re.compile(r'<(!--|[a-zA-Z][\w:-]*)')
+
+VOIDTAGS = frozenset(['hr', 'br', 'img', 'input', 'link', 'meta'])
+
+def htmlend(line):
+    r"""
+    Get the end marker of a raw HTML block starting with `line`.
+
+    Returns `None` if `line` does not start an HTML block or if it already
+    contains the block's end.
+
+    >>> htmlend("<div>\n"), htmlend("<!-- foo\n")
+    ('</div', '-->')
+    >>> htmlend("<div>foo</div>\n"), htmlend("<hr>\n"), htmlend("1 < 2\n")
+    (None, None, None)
+
+    """
+    match = RXHTMLTAG.match(line)
+    if not match:
+        return None
+    tag = match.group(1).lower()
+    end = "-->" if tag == "!--" else "</%s" % tag
+    if tag in VOIDTAGS or end in line[match.end():].lower():
+        return None
+    return end
+
+def segments(fp, size=SEGMENTSIZE):
+    r"""
+    Split the lines read from `fp` into segments at safe block boundaries.
+
+    Segments have at least `size` characters (except the last one). Yields
+    the number of lines preceding each segment and the segment's text.
+
+    >>> lines = ["foo\n", "\n", "* bar\n", "\n", "[1]: /x\n", "\n",
+    ...          "    baz\n", "\n", "```\n", "\n", "qux\n", "```\n", "\n",
+    ...          "quux\n"]
+    >>> for offset, text in segments(lines, size=1):
+    ...     print offset, repr(text)
+    0 'foo\n\n* bar\n\n[1]: /x\n\n    baz\n\n'
+    8 '```\n\nqux\n```\n\n'
+    13 'quux\n'
+
+    """
+    lines, length, offset = [], 0, 0
+    blank, fence, html, deflist, reference = True, None, None, False, False
+    for line in fp:
+        if (length >= size and blank and not fence and not html and
+            not deflist and not reference and not RXNOBOUNDARY.match(line)):
+            yield offset, "".join(lines)
+            offset += len(lines)
+            lines, length = [], 0
+        lines.append(line)
+        length += len(line)
+        reference = False
+        if fence:
+            if line.rstrip(WHITESPACE) == fence:
+                fence = None
+        elif html:
+            if html in line.lower():
+                html = None
+        elif RXREFERENCE.match(line):
+            # removed by PyMD's preprocessors, and may be followed by a title
+            reference = True
+            continue
+        else:
+            match = RXFENCE.match(line)
+            if match:
+                fence = match.group(1)
+            elif blank and line.startswith("<"):
+                html = htmlend(line)
+            # a block following a definition list may continue it
+            if RXDEFINITION.match(line):
+                deflist = True
+            elif blank and line[:1] not in WHITESPACE:
+                deflist = False
+        blank = not line.strip(WHITESPACE)
+    if lines:
+        yield offset, "".join(lines)
+
+def readsegments(fname, encoding="UTF8", size=SEGMENTSIZE):
+    """Read the segments of file `fname` (see `segments()`)."""
+
+    with io.open(fname, 'r', encoding=encoding, newline='') as fp:
+        for segment in segments(fp, size):
+            yield segment
+
+# =============================================================================
+
+class Skip(object):
+    """A preprocessor which does nothing."""
+
+    def run(self, lines):
+        return lines
+
+def definitions(converter, fname, encoding="UTF8", size=SEGMENTSIZE):
+    """
+    Collect the link references and abbreviations of the Markdown file
+    `fname`, segment by segment.
+
+    Returns definitions as given by `Converter.definitions()`.
+
+    """
+    md = converter.md
+    meta = md.preprocessors['meta'] if 'meta' in md.preprocessors else None
+    references, patterns = {}, []
+    keys = {}
+    try:
+        for i, (_, segment) in enumerate(readsegments(fname, encoding, size)):
+            if i == 1 and meta:
+                md.preprocessors['meta'] = Skip()
+            converter.preprocess(segment)
+            refs, pats = converter.definitions()
+            references.update(refs)
+            for key, pattern in pats: # like PyMD's ordered dictionaries
+                if key in keys:
+                    patterns[keys[key]] = key, pattern
+                else:
+                    keys[key] = len(patterns)
+                    patterns.append((key, pattern))
+    finally:
+        if meta:
+            md.preprocessors['meta'] = meta
+    converter.reset()
+    return references, patterns
+
+def _iterconvert(converter, segments, defs, diagnostics):
+    """Yield the post-processed wiki text pieces of all `segments`."""
+
+    md, tp = converter.md, converter.tp
+    meta = md.preprocessors['meta'] if 'meta' in md.preprocessors else None
+    context = ""
+    try:
+        for i, (offset, segment) in enumerate(segments):
+            if i == 1 and meta: # meta-data is at the start of a document only
+                md.preprocessors['meta'] = Skip()
+            root = converter.treeprocess(converter.parseblocks(segment, defs))
+            for wiki in tp.iterconvert(root, context):
+                context = trailing(context, wiki)
+                if wiki:
+                    yield converter.postprocess(wiki)
+            if diagnostics is not None:
+                diagnostics.extend(x._replace(line=x.line + offset) if x.line
+                                   else x for x in converter.diagnostics())
+    finally:
+        if meta:
+            md.preprocessors['meta'] = meta
+
+def checkextensions(converter):
+    """
+    Raise a `ValueError` if `converter` uses extensions which need to see the
+    whole document, or if it does not convert Markdown.
+
+    """
+    if converter.frontend != 'markdown':
+        raise ValueError("segment-wise conversions work with Markdown only")
+    names = [k for k, v in converter.md.treeprocessors.items()
+             if v is not converter.tp and k not in STREAMTREEPROCESSORS]
+    if names:
+        raise ValueError("segment-wise conversions do not support the '%s' "
+                         "extension(s)" % "', '".join(names))
+
+def iterconvert(converter, fname, encoding="UTF8", size=SEGMENTSIZE,
+                diagnostics=None):
+    """
+    Convert the Markdown file `fname` segment by segment using `converter`.
+
+    Returns an iterator over the wiki text, like `Converter.iterconvert()`.
+    The first segment is converted right away, any subsequent segment only
+    when consuming the wiki text, i.e. `BadURL` and `UnknownTag` exceptions
+    may also be raised while iterating. If a `diagnostics` list is given,
+    diagnostics get appended to it as segments are converted.
+
+    Raises a `ValueError` if the converter uses extensions which need to see
+    the whole document.
+
+    """
+    checkextensions(converter)
+    defs = definitions(converter, fname, encoding, size)
+    pieces = _iterconvert(converter, readsegments(fname, encoding, size),
+                          defs, diagnostics)
+    # the first piece, to convert the first segment and get its pragmas
+    pieces = itertools.chain(list(itertools.islice(pieces, 1)), pieces)
+    return converter._iterconvert(pieces)
+
+def convert(converter, fname, encoding="UTF8", size=SEGMENTSIZE):
+    """
+    Convert the Markdown file `fname` segment by segment using `converter`.
+
+    Returns the wiki text (which is useful for testing, but defeats the
+    purpose of streaming conversions).
+
+    """
+    return "".join(iterconvert(converter, fname, encoding, size))
@@ -0,0 +1,220 @@
+"""
+Cache of parsed documents, shared by converters with different options.
+
+Parsing Markdown (i.e. running PyMD's preprocessors, block parser, and tree
+processors) is the most expensive part of a conversion, yet it only depends
+on a document's source and the Markdown extensions in use -- options like
+`imagebaseurl` or `htmlimages` are only used when converting the parsed
+element tree. A `TreeCache` keeps parsed documents, i.e. their element tree,
+their meta-data (see the *meta* extension), and their stashed raw HTML, so
+converting a document with N different sets of options costs one parse and
+N conversions of the element tree:
+
+    >>> from markowik import Converter
+    >>> cache = TreeCache()
+    >>> src = "Some *text* and an ![image](x.png)"
+    >>> for baseurl in ("http://a.org/", "http://b.org/"):
+    ...     print Converter(imagebaseurl=baseurl, treecache=cache).convert(src)
+    Some _text_ and an http://a.org/x.png
+    Some _text_ and an http://b.org/x.png
+    >>> sorted(cache.stats().items())
+    [('hits', 1), ('maxsize', 100), ('misses', 1), ('size', 1)]
+
+Parsed documents may also be stored in a directory, which is useful when
+different options are used by different processes (e.g. by consecutive
+runs of the command line tool, see its ``--tree-cache`` option). Cache
+files are named by the key of a document (see `key()`) and are never
+removed by Markowik.
+
+Parse results of extensions which keep document specific state outside of
+the element tree, the meta-data, or the raw HTML stash (none of PyMD's
+bundled extensions does) are not cached.
+
+"""
+import cPickle as pickle
+import hashlib
+import json
+import os
+import threading
+
+from collections import namedtuple
+
+from markowik.util import LRUCache
+
+# =============================================================================
+
+def extensionnames(mx):
+    """
+    Get names of Markdown extensions `mx` (names or extension instances).
+
+    >>> from markdown.extensions.abbr import AbbrExtension
+    >>> extensionnames(['tables', AbbrExtension()])
+    ['tables', 'markdown.extensions.abbr.AbbrExtension']
+
+    """
+    return [x if isinstance(x, basestring) else
+            "%s.%s" % (x.__class__.__module__, x.__class__.__name__)
+            for x in mx or []]
+
+def key(src, mx):
+    """
+    Get a key for Markdown source `src` parsed with extensions `mx`.
+
+    The key also covers the Markowik and PyMD versions.
+
+    """
+    import markdown
+    import markowik
+
+    sha = hashlib.sha1(json.dumps([extensionnames(mx), markowik.__version__,
+                                   markdown.version]))
+    sha.update(unicode(src).encode('UTF8'))
+    return sha.hexdigest()
+
+# =============================================================================
+
+class Parsed(namedtuple('Parsed', 'nodes meta html')):
+    """
+    A parsed document: its element tree in a flat form (see `freeze()`), its
+    meta-data (`None` if the *meta* extension is not used), and its stashed
+    raw HTML blocks.
+
+    """
+    __slots__ = ()
+
+def freeze(root, md):
+    """
+    Get a `Parsed` document from the element tree `root` and the state of
+    the PyMD instance `md`.
+
+    Elements are given as a list of parent index, tag, attributes, text, and
+    tail tuples in document order (which is quick to pickle, and to turn into
+    a tree again, even for deeply nested elements).
+
+    """
+    nodes = []
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        nodes.append((parent, node.tag, dict(node.attrib), node.text,
+                      node.tail))
+        index = len(nodes) - 1
+        stack.extend((child, index) for child in reversed(node))
+    meta = getattr(md, 'Meta', None)
+    if meta is not None:
+        meta = dict((k, list(v)) for k, v in meta.items())
+    return Parsed(nodes, meta, list(md.htmlStash.rawHtmlBlocks))
+
+def thaw(parsed, md):
+    """
+    Restore the state of the PyMD instance `md` for a `Parsed` document and
+    get its element tree (a new one for each call).
+
+    >>> import markdown
+    >>> md = markdown.Markdown()
+    >>> root = md.parser.parseDocument(["* foo", "", "    > bar"]).getroot()
+    >>> markdown.util.etree.tostring(thaw(freeze(root, md), md))
+    '<div><ul><li><p>foo</p><blockquote><p>bar</p></blockquote></li></ul></div>'
+
+    """
+    from markdown.util import etree
+
+    nodes = []
+    for parent, tag, attrib, text, tail in parsed.nodes:
+        if parent < 0:
+            node = etree.Element(tag, attrib)
+        else:
+            node = etree.SubElement(nodes[parent], tag, attrib)
+        node.text, node.tail = text, tail
+        nodes.append(node)
+    if parsed.meta is not None:
+        md.Meta = dict((k, list(v)) for k, v in parsed.meta.items())
+    md.htmlStash.rawHtmlBlocks = list(parsed.html)
+    md.htmlStash.html_counter = len(parsed.html)
+    return nodes[0]
+
+# =============================================================================
+
+class TreeCache(object):
+    """
+    Cache of parsed documents, to be passed to converters as `treecache`.
+
+    Keeps up to `size` parsed documents in memory and, if a `directory` is
+    given, all of them in that directory (which gets created if needed).
+    Tree caches may be shared by threads. When passed to other processes
+    (e.g. with converter options, see `markowik.batch`), only the directory
+    and size are passed, not the parsed documents in memory.
+
+    """
+    def __init__(self, directory=None, size=100):
+        self.directory = directory
+        self.size = size
+        self.lock = threading.Lock()
+        self.memory = LRUCache(size)
+        self.hits = self.misses = 0
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def filename(self, key):
+        """Get the name of the file caching the document given by `key`."""
+
+        return os.path.join(self.directory, "%s.tree" % key)
+
+    def get(self, key):
+        """Get the `Parsed` document given by `key`, or `None`."""
+
+        with self.lock:
+            parsed = self.memory.get(key)
+        if parsed is None and self.directory:
+            parsed = self.load(key)
+        with self.lock:
+            if parsed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.memory[key] = parsed
+        return parsed
+
+    def load(self, key):
+        """Load the `Parsed` document given by `key` from the directory."""
+
+        try:
+            with open(self.filename(key), 'rb') as fp:
+                return Parsed(*pickle.load(fp))
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return None # not cached (or written by another version)
+
+    def __setitem__(self, key, parsed):
+
+        with self.lock:
+            self.memory[key] = parsed
+        if not self.directory:
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError: # created concurrently by another process
+                if not os.path.isdir(self.directory):
+                    raise
+        fname = self.filename(key)
+        tmpname = "%s.%d.%d.tmp" % (fname, os.getpid(),
+                                    threading.current_thread().ident)
+        with open(tmpname, 'wb') as fp:
+            pickle.dump(tuple(parsed), fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, fname)
+
+    def stats(self):
+        """
+        Get the number of cache hits and misses (in memory or on disk), and
+        the number and maximum number of documents in memory.
+
+        """
+        with self.lock:
+            stats = self.memory.stats()
+            stats.update(hits=self.hits, misses=self.misses)
+        return stats
@@ -1,11 +1,10 @@
 """Miscellaneous utilities."""
 
+import codecs
 import os
 import re
 import sys
 
-from markdown.util import etree, STX, ETX
-
 # -----------------------------------------------------------------------------
 
 _rxwikiword = re.compile(r'(?<![a-z0-9])'
@@ -42,8 +41,226 @@ def escapewikiwords(text):
     """
     return _rxwikiword.sub(r'!\1', text)
 
+_markupescapes = {'`': '{{{`}}}', '{{{': '`{{{`', '}}}': '`}}}`'}
+
+_rxmarkup = re.compile(r'{{{|}}}|[`[\]_*]')
+
+_rxmarkupwikiword = re.compile(r'%s|%s' % (_rxwikiword.pattern,
+                                           _rxmarkup.pattern))
+
+def _escapematch(match):
+
+    x = match.group()
+    if match.lastindex: # WikiWord
+        return "!%s" % x.replace("_", "`_`")
+    return _markupescapes.get(x) or "`%s`" % x
+
+def escape(text, wikiwords=True):
+    """
+    Escape GCW markup characters and, if `wikiwords` is true, WikiWords.
+
+    This is done in one pass and yields the same as escaping WikiWords with
+    `escapewikiwords()` followed by escaping markup characters.
+
+    >>> print escape("FooBar_Baz and *x* or y_z")
+    !FooBar`_`Baz and `*`x`*` or y`_`z
+
+    >>> print escape("FooBar_Baz and *x*", wikiwords=False)
+    FooBar`_`Baz and `*`x`*`
+
+    >>> print escape("{{{code}}}, `code`, and [link]")
+    `{{{`code`}}}`, {{{`}}}code{{{`}}}, and `[`link`]`
+
+    """
+    if wikiwords:
+        return _rxmarkupwikiword.sub(_escapematch, text)
+    return _rxmarkup.sub(_escapematch, text)
+
+class Escaper(object):
+    """
+    Escapes text like `escape()` but optionally caches results and keeps
+    selected WikiWords.
+
+    If `wikiwords` is false, WikiWords are never escaped. If it is a
+    collection of page names, WikiWords matching one of them are not escaped
+    (i.e. GCW links them). Results for up to `cachesize` distinct text
+    fragments are cached (set to 0 to disable caching).
+
+    >>> escaper = Escaper(wikiwords=["FooBar"])
+    >>> print escaper("FooBar, BarBaz, and x_y")
+    FooBar, !BarBaz, and x`_`y
+    >>> print escaper("FooBar, BarBaz, and x_y", wikiwords=False)
+    FooBar, BarBaz, and x`_`y
+    >>> print escaper("FooBar, BarBaz, and x_y")
+    FooBar, !BarBaz, and x`_`y
+    >>> sorted(escaper.cache.stats().items())
+    [('hits', 1), ('maxsize', 1000), ('misses', 2), ('size', 2)]
+
+    An `instrument` (see `markowik.instrument`) gets notified about escapes
+    and cache hits and misses:
+
+    >>> from markowik.instrument import Stats
+    >>> stats = Stats()
+    >>> escaper = Escaper(cachesize=0, instrument=stats)
+    >>> print escaper("FooBar_Baz and *x* or y_z")
+    !FooBar`_`Baz and `*`x`*` or y`_`z
+    >>> sorted(stats.counters.items())
+    [('escaped markup', 3), ('escaped wikiwords', 1)]
+
+    """
+    def __init__(self, wikiwords=True, cachesize=1000, instrument=None):
+        self.wikiwords = bool(wikiwords)
+        if wikiwords is True or not wikiwords:
+            self.pagenames = frozenset()
+        else:
+            self.pagenames = frozenset(wikiwords)
+        self.cache = LRUCache(cachesize) if cachesize else None
+        self.instrument = instrument
+        self.nmarkup = 0 # number of escaped markup characters
+        self.nwikiwords = 0 # number of escaped WikiWords
+
+        self.rx = _rxmarkupwikiword if self.wikiwords else _rxmarkup
+        if instrument or self.pagenames:
+            self.repl = self.replace
+        else: # no need for counting and page name checks
+            self.repl = _escapematch
+
+    # escaping short texts is faster than looking them up in the cache
+    CACHEMINLEN = 16
+
+    def replace(self, match):
+
+        x = match.group()
+        if match.lastindex: # WikiWord
+            if x in self.pagenames:
+                return x
+            self.nwikiwords += 1
+            return "!%s" % x.replace("_", "`_`")
+        self.nmarkup += 1
+        return _markupescapes.get(x) or "`%s`" % x
+
+    def escape(self, text, wikiwords=True):
+        """Escape `text` (without caching)."""
+
+        if wikiwords:
+            return self.rx.sub(self.repl, text)
+        return _rxmarkup.sub(self.repl, text)
+
+    def __call__(self, text, wikiwords=True):
+
+        if self.instrument:
+            return self.counted(text, wikiwords)
+        cache = self.cache
+        if cache is None or len(text) < self.CACHEMINLEN:
+            rx = self.rx if wikiwords else _rxmarkup
+            return rx.sub(self.repl, text)
+        key = (text, wikiwords)
+        wiki = cache.get(key)
+        if wiki is None:
+            wiki = cache[key] = self.escape(text, wikiwords)
+        return wiki
+
+    def counted(self, text, wikiwords):
+        """Escape `text` and report escapes to the instrument."""
+
+        # cache entries additionally contain the number of escapes
+        instrument = self.instrument
+        cache = self.cache
+        if cache is None or len(text) < self.CACHEMINLEN:
+            entry = None
+        else:
+            key = (text, wikiwords)
+            entry = cache.get(key)
+            instrument.count('escape cache %s' % ('misses' if entry is None
+                                                  else 'hits'))
+        if entry is None:
+            nmarkup, nwikiwords = self.nmarkup, self.nwikiwords
+            entry = (self.escape(text, wikiwords), self.nmarkup - nmarkup,
+                     self.nwikiwords - nwikiwords)
+            if cache is not None and len(text) >= self.CACHEMINLEN:
+                cache[key] = entry
+        if entry[1]:
+            instrument.count('escaped markup', entry[1])
+        if entry[2]:
+            instrument.count('escaped wikiwords', entry[2])
+        return entry[0]
+
+class LRUCache(object):
+    """
+    A mapping of limited size which drops least recently used items.
+
+    Items are set with ``cache[key] = value`` and retrieved with `get()`,
+    which also counts cache hits and misses.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3 # drops 'b'
+    >>> cache.get('b'), cache.get('c'), cache.get('a')
+    (None, 3, 1)
+    >>> sorted(cache.stats().items())
+    [('hits', 3), ('maxsize', 2), ('misses', 1), ('size', 2)]
+
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        """Remove all items."""
+
+        # items are kept in a circular doubly linked list of `[previous, next,
+        # key, value]` links, most recently used ones next to the root link
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        self.links = {}
+
+    def get(self, key, default=None):
+        """Get the value of `key` (or `default` if not in the cache)."""
+
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
+        root = self.root
+        first = root[1]
+        link[0], link[1] = root, first
+        root[1] = first[0] = link
+        return link[3]
+
+    def __setitem__(self, key, value):
+
+        links, root = self.links, self.root
+        if key in links:
+            links[key][3] = value
+            return
+        if len(links) >= self.maxsize:
+            last = root[0]
+            root[0] = last[0]
+            last[0][1] = root
+            del links[last[2]]
+        first = root[1]
+        root[1] = first[0] = links[key] = [root, first, key, value]
+
+    def __len__(self):
+        return len(self.links)
+
+    def stats(self):
+        """Get the number of cache hits and misses, the size and maxsize."""
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self), 'maxsize': self.maxsize}
+
 # -----------------------------------------------------------------------------
 
+# read-only and process-wide (set by the environment at import time)
 DEBUG = "MARKOWIK_DEBUG" in os.environ
 
 def dump(obj, title=None):
@@ -55,6 +272,7 @@ def dump(obj, title=None):
     """
     if not DEBUG:
         return
+    from markdown.util import etree
     title = (" %s " % title) if title else ""
     print(title.center(79, "-"))
     if obj is None:
@@ -66,19 +284,74 @@ def dump(obj, title=None):
 
 # -----------------------------------------------------------------------------
 
-VERBOSE = False
+def logger(verbose=True, fp=None):
+    r"""
+    Get a function which logs messages to `fp` (default: stderr).
+
+    Messages are only logged if `verbose` is true. PyMD-special string
+    fractions are sanitized before logging.
+
+    >>> import StringIO
+    >>> fp = StringIO.StringIO()
+    >>> logger(fp=fp)(u"a \u0002wzxhzdk:0\u0003 b")
+    >>> fp.getvalue()
+    u'info: a <..>..<..> b\n'
 
-def log(msg):
     """
-    Log `msg` to stderr (if verbose mode is on).
+    def log(msg):
+        if verbose:
+            (fp or sys.stderr).write("info: %s\n" % sanitize(msg))
+    return log
 
-    PyMD-special string fractions are sanitized before logging.
+# PyMD placeholders, as marked by `markdown.util.STX` and `markdown.util.ETX`
+_rxplaceholder = re.compile(u'\u0002.*?\u0003')
 
+def sanitize(text):
     """
-    if not VERBOSE:
-        return
-    msg = re.sub('%s.*?%s' % (STX, ETX), '<..>..<..>', msg)
-    sys.stderr.write("info: %s\n" % msg)
+    Replace PyMD placeholders (e.g. for stashed HTML) in `text`.
+
+    >>> sanitize(u"a \u0002wzxhzdk:0\u0003 b")
+    u'a <..>..<..> b'
+
+    """
+    return _rxplaceholder.sub('<..>..<..>', text)
+
+# -----------------------------------------------------------------------------
+
+def peakmemory():
+    """
+    Get the peak memory usage (resident set size) of this process in bytes.
+
+    Returns `None` if unknown (e.g. on Windows).
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # KiB on Linux
+
+# -----------------------------------------------------------------------------
+
+def writefile(fname, pieces, encoding):
+    """
+    Write text `pieces` to file `fname`, using `encoding`.
+
+    The text is written to a temporary file first, which replaces `fname`
+    once all pieces are written. If getting a piece fails (e.g. because of a
+    conversion error), `fname` is left untouched.
+
+    """
+    tmpname = "%s.%d.tmp" % (fname, os.getpid())
+    try:
+        with codecs.open(tmpname, 'w', encoding) as fp:
+            for piece in pieces:
+                fp.write(piece)
+        os.rename(tmpname, fname)
+    finally:
+        if os.path.exists(tmpname): # not renamed
+            os.remove(tmpname)
 
 # -----------------------------------------------------------------------------
 
@@ -95,7 +368,9 @@ def truncate(text, width=15):
     '12345...'
     >>> truncate("12\\n34", 10)
     '12 34'
+    >>> truncate(None)
+    ''
 
     """
-    text = text.replace("\n", " ")
+    text = (text or "").replace("\n", " ")
     return "%s..." % text[:width-3] if len(text) > width else text
@@ -1,5 +1,6 @@
 import codecs
 import difflib
+import functools
 import glob
 import os
 import subprocess
@@ -8,6 +9,10 @@ import sys
 HERE = os.path.dirname(__file__)
 MARKOWIK = os.path.join(HERE, "..", "..", "bin", "markowik")
 
+# additional directories with test files (e.g. real-world regression corpora)
+FIXTURES = os.environ.get("MARKOWIK_FIXTURES", "").split(os.pathsep)
+FIXTURES = [x for x in FIXTURES if x]
+
 def readoptions(fname):
     """
     Read `markowik` options from a file, one per line.
@@ -30,55 +35,191 @@ def iterfiles(*exts):
     all subsequent items are test file paths, one for each file extension given
     in `exts`.
 
-    """
-    inputs = glob.glob(os.path.join(HERE, "*.md"))
-    for fname in inputs:
-        name = os.path.splitext(os.path.basename(fname))[0]
-        yield [name] + [os.path.join(HERE, "%s.%s" % (name, x)) for x in exts]
+    Test files are looked up in this directory and in the directories given
+    by the environment variable `MARKOWIK_FIXTURES`.
 
-def _test(testdata):
     """
-    Test a specific test file (`testdata` is a list of related filenames).
-
+    for path in [HERE] + FIXTURES:
+        inputs = sorted(glob.glob(os.path.join(path, "*.md")))
+        for fname in inputs:
+            base = os.path.splitext(fname)[0]
+            name = os.path.basename(base)
+            if path != HERE:
+                name = os.path.relpath(base, os.path.dirname(path))
+            yield [name] + ["%s.%s" % (base, x) for x in exts]
+
+def compare(wikifile, out, outname):
     """
-    mdfile, wikifile, outfile, cfgfile = testdata
-
-    # --- options ---------------------------------------------------------
-
-    options = readoptions(cfgfile)
-
-    # --- run converter ---------------------------------------------------
+    Compare the expected wiki text in `wikifile` with the actual one, `out`.
 
-    ret = subprocess.call([MARKOWIK, "--quiet", mdfile, outfile] + options)
-    assert ret == os.EX_OK
-
-    # --- load expected and actual results --------------------------------
+    Differences are written to stdout (`outname` names the actual wiki text).
 
+    """
     with codecs.open(wikifile, 'r', 'UTF8') as fp:
         wiki = fp.read().strip("\n") + "\n"
-    with codecs.open(outfile, 'r', 'UTF8') as fp:
-        out = fp.read().strip("\n") + "\n"
-
-    os.remove(outfile)
-
-    # --- compare results -------------------------------------------------
+    out = out.strip("\n") + "\n"
 
     if wiki != out:
         alines, blines = wiki.splitlines(True), out.splitlines(True)
         delta = difflib.unified_diff(alines, blines, fromfile=wikifile,
-                                     tofile=outfile)
+                                     tofile=outname)
         for line in delta:
-            sys.stdout.write(line)
+            sys.stdout.write(line.encode('UTF8'))
         assert False
 
+# =============================================================================
+# in-process conversion of test files
+# =============================================================================
+
+_converters = {} # per process, by options
+
+def _convert(testdata):
+    """
+    Convert a test file (`testdata` is a Markdown and a config file name).
+
+    Returns the wiki text and an error message (`None` on success).
+
+    """
+    from markowik.main import Converter, options, converteroptions
+
+    mdfile, cfgfile = testdata
+    args = readoptions(cfgfile)
+    key = tuple(args)
+    try:
+        if key not in _converters:
+            kwds = converteroptions(options([mdfile] + args))
+            _converters[key] = Converter(**kwds)
+        with codecs.open(mdfile, 'r', 'UTF8') as fp:
+            md = fp.read()
+        return _converters[key].convert(md), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+def convertall(tests, jobs=None):
+    """
+    Convert test files given by `tests`, a list of `_convert()` jobs.
+
+    Test files are converted by `jobs` processes (default: number of CPUs).
+    Returns a list of `_convert()` results.
+
+    """
+    import multiprocessing
+
+    jobs = jobs or multiprocessing.cpu_count()
+    if jobs == 1 or len(tests) < 2 or sys.platform == 'win32':
+        return [_convert(x) for x in tests]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_convert, tests, chunksize=8)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def _test(wikifile, result):
+    """
+    Check the conversion `result` of a test file (see `_convert()`).
+
+    """
+    out, error = result
+    assert error is None, error
+    compare(wikifile, out, "<converted>")
+
 def test():
     """
     Test all test files
 
-    This is a *nose* test generator function.
+    This is a *nose* test generator function. Test files are converted in
+    parallel before checking the results one by one.
+
+    """
+    tests = list(iterfiles("md", "wiki", "cfg"))
+    results = convertall([(x[1], x[3]) for x in tests])
+    for x, result in zip(tests, results):
+
+        check = functools.partial(_test, x[2], result)
+        check.description = x[0]
+        yield check,
+
+# =============================================================================
+# conversion of test files rendered to XHTML (see `markowik.frontend`)
+# =============================================================================
+
+def _converthtml(testdata):
+    """
+    Convert a test file from the XHTML rendered by PyMD (`testdata` is like
+    for `_convert()`).
+
+    Returns `_convert()` like results for the XHTML given as a complete
+    XHTML document, as an HTML document (parsed leniently, see
+    `markowik.frontend.parsehtml()`), and as an element tree.
 
     """
-    for x in iterfiles("md", "wiki", "out", "cfg"):
+    import cgi
+    import markdown
+    from markdown.util import etree
+    from markowik.main import Converter, options, converteroptions
+
+    mdfile, cfgfile = testdata
+    kwds = converteroptions(options([mdfile] + readoptions(cfgfile)))
+    with codecs.open(mdfile, 'r', 'UTF8') as fp:
+        md = markdown.Markdown(extensions=kwds['mx'] or [])
+        html = md.convert(fp.read())
+    meta = getattr(md, 'Meta', {})
+    kwds['frontend'] = 'html'
+    converter = Converter(**kwds)
+
+    head = "".join('<meta name="%s" content="%s" />' % (k, cgi.escape(v, True))
+                   for k, values in sorted(meta.items()) for v in values)
+    xhtml = "<html><head>%s</head><body>%s</body></html>" % (head, html)
+    root = etree.fromstring((u"<div>%s</div>" % html).encode('UTF8'))
+    results = []
+    for convert, args in [(converter.convert, (xhtml,)),
+                          (converter.convert, ("<!DOCTYPE html>" + xhtml,)),
+                          (converter.converttree, (root, meta))]:
+        try:
+            results.append((convert(*args), None))
+        except Exception as e:
+            results.append((None, "%s: %s" % (type(e).__name__, e)))
+    return results
+
+def test_html():
+    """
+    Test all test files, rendered to XHTML by PyMD
+
+    This is a *nose* test generator function. The converted XHTML must yield
+    the expected wiki text, given in a ``.html.wiki`` file where it differs
+    from the ``.wiki`` file (raw HTML in Markdown is not converted, in XHTML
+    known elements are).
+
+    """
+    for x in iterfiles("md", "wiki", "cfg", "html.wiki"):
+        wikifile = x[4] if os.path.exists(x[4]) else x[2]
+        results = _converthtml((x[1], x[3]))
+        for how, result in zip(("xhtml", "html", "tree"), results):
+            check = functools.partial(_test, wikifile, result)
+            check.description = "%s (%s)" % (x[0], how)
+            yield check,
+
+# =============================================================================
+# command line smoke test
+# =============================================================================
+
+def test_cli():
+    """
+    Test converting a test file using the command line tool.
+
+    """
+    mdfile, wikifile, outfile = [os.path.join(HERE, "simple.%s" % x)
+                                 for x in ("md", "wiki", "out")]
+
+    ret = subprocess.call([MARKOWIK, "--quiet", mdfile, outfile])
+    assert ret == os.EX_OK
+
+    with codecs.open(outfile, 'r', 'UTF8') as fp:
+        out = fp.read()
+    os.remove(outfile)
 
-        _test.description = x[0]
-        yield _test, x[1:]
+    compare(wikifile, out, outfile)